@@ -71,7 +71,9 @@ plt.legend();
 
 # Run the following cells to import yet more tools.
 
-import copy
+import time
+from collections import Counter
+
 import numpy.random as rnd
 import scipy.linalg as sla
 from matplotlib.ticker import LogLocator
@@ -99,7 +101,7 @@ seed = rnd.seed(4)  # very easy
 
 import simulator
 import simulator.plotting as plots
-from tools import geostat, misc
+from tools import cache, distributed, geostat, misc, parallel
 from tools.misc import center
 
 # In short, the model is a 2D, two-phase, immiscible, incompressible simulator using
@@ -160,6 +162,7 @@ wsat = Dict(
 
 # +
 def sample_prior_perm(N):
+    # NB: for large grids, use `geostat.gaussian_fields_fft` (same distribution)
     lperms = geostat.gaussian_fields(model.mesh(), N, r=0.8)
     return lperms
 
@@ -323,6 +326,8 @@ plots.fields(perm.Prior, "pperm", "Prior");
 # In practice, of course, we would not be using an explicit `Cov` matrix when generating
 # the prior ensemble, because it would be too large.  However, since this synthetic case
 # in being made that way, let's inspect its spectrum.
+# (For a smooth prior, i.e. a quickly decaying spectrum, it could also be sampled
+# from its leading eigenvectors only, using `geostat.kl_fields`.)
 
 U, svals, VT = sla.svd(perm.Prior)
 plots.spectrum(svals, "Prior cov.");
@@ -348,59 +353,233 @@ plots.spectrum(svals, "Prior cov.");
 
 # Set (int) number of CPU cores to use. Set to False when debugging.
 multiprocess = False
+# Use threads (rather than processes) for the above. This avoids start-up and pickling
+# costs, and works where `fork` is problematic (e.g. some notebook environments),
+# but only the parts of the simulator that release the GIL (mainly the linear algebra)
+# run concurrently.
+threads = False
+# Alternatively, set to (host, port) to serve the member simulations to workers
+# on several machines (see `tools/distributed.py`), e.g. `("", 50000)`.
+# Then `multiprocess` sets the number of workers started on this machine.
+cluster = False
+# Set to `np.float32` to halve the memory used to store the ensemble trajectories.
+# NB: the simulations themselves are still computed in double precision.
+store_dtype = np.float64
+# Max. time (in seconds) for the simulation of a single member, and the number of
+# retries (with smaller time steps) of members whose simulation fails (diverges or
+# times out). Members that still fail are recorded, and dropped by the assimilation.
+# The time limit is checked between time steps. In parallel, it is also enforced by
+# the pool (for members stuck within a step, or whose worker died).
+member_timeout = None
+retries = 1
+# Set to True to record the wall times (by phase) and counts of the simulations (see
+# `ResSim.stats`). They are returned (per member) by `forward_model`, and accumulated
+# (over all members and calls) in `sim_stats`.
+instrument = False
+sim_stats = Counter()
+
+def run1(estimable, nTime, snapshots=None, pressures=False):
+    """Forward model for a *single* member/realisation.
+
+    Returns the saturations, productions, and a `Dict` of extra outputs: the `stats`
+    (if `instrument`), and (if `pressures`) the `pressures` solutions.
+    If `pressures == "seed"`, the last item of `estimable` is initial guesses for them
+    (see `forward_model`).
+    """
+    # Unpack variables
+    if pressures == "seed":
+        *estimable, guesses = estimable
+    wsat0, perm, *rates = estimable
+
+    # Derive the member's model from the template. Unlike `copy.deepcopy(model)`,
+    # this shares the grid (etc.), and only creates the member's own parameters,
+    # which avoids the risk (difficult to diagnose with multiprocessing) that
+    # the parameter values of one member overwrite those of another.
+    # Production rates are set if provided: the historical rates (couble be, but)
+    # are not unknowns; instead, this "setter" is provided for the purpose
+    # of optimising future production.
+    model_n = model.with_params(rates=rates[0] if rates else None)
+
+    # Set permeabilities
+    set_perm(model_n, perm)
+
+    # Run simulator. If it fails, retry with smaller time steps.
+    for attempt in range(retries + 1):
+        model_n = model_n.with_params()  # reset (time stepping state)
+        if pressures:
+            model_n.pressure_log = []
+        if instrument:
+            model_n.stats = Counter()
+        if pressures == "seed" and attempt == 0:
+            # Drop the padding (NaN), see `forward_model`
+            model_n.pressure_guesses = iter(guesses[np.isfinite(guesses).all(axis=1)])
+        if member_timeout:
+            model_n.deadline = time.monotonic() + member_timeout
+        k = 2**attempt  # number of sub-steps per time step
+
+        def step(x, dt):
+            for _ in range(k):
+                x = model_n.step(x, dt/k)
+            return x
+
+        try:
+            wsats, prods = misc.repeat(step, nTime, wsat0, dt, obs_model, pbar=False,
+                                       dtype=store_dtype, snapshots=snapshots)
+            extra = Dict(stats=model_n.stats)
+            if pressures:
+                extra.pressures = np.array(model_n.pressure_log)
+            return wsats, prods, extra
+        except (ArithmeticError, RuntimeError, TimeoutError) as e:
+            error = e
+
+    # Return (rather than raise) the error, so that the other members are not lost.
+    return error
+
+# The pool of worker processes is started (on first use) only once, and then re-used.
+# NB: worker processes thus hold a copy of `model` (etc.) as it was at that time.
+# They are restarted if the settings (`model`, `dt`, ...) change, but changes to
+# the code (e.g. of `perm_transf`) are not detected; then set `pool = None`.
+pool = None
+
+class Forecast(tuple):
+    """The `(saturation, production)` of `forward_model`, and its `failed` members.
+
+    `failed` is a dict of the errors, by member index.
+    `pressures` are the pressure solutions (if requested, see `forward_model`).
+    `stats` are the instrumentation (`ResSim.stats`) of each member (if `instrument`),
+    and `total` their sum.
+    The outputs of the failed members are filled with NaNs,
+    so that they can be identified (and dropped) also after unpacking.
+    """
 
-def forward_model(nTime, *args, desc=""):
-    """Create the (composite) forward model, i.e. forecast. Supports ensemble input."""
-
-    def run1(estimable):
-        """Forward model for a *single* member/realisation."""
-        # Avoid the risk (difficult to diagnose with multiprocessing) that
-        # the parameter values of one member overwrite those of another.
-        # Alternative: re-initialize the model.
-        model_n = copy.deepcopy(model)
-
-        # Unpack variables
-        wsat0, perm, *rates = estimable
-
-        # Set production rates, if provided.
-        if rates:
-            # The historical rates (couble be, but) are not unknowns;
-            # Instead, this "setter" is provided for the purpose
-            # of optimising future production.
-            model_n.producers[:, 2] = rates[0]
-            model_n.config_wells(model_n.injectors, model_n.producers, remap=False)
-
-        # Set permeabilities
-        set_perm(model_n, perm)
-
-        # Run simulator
-        wsats, prods = misc.repeat(
-            model_n.step, nTime, wsat0, dt, obs_model, pbar=False)
-
-        return wsats, prods
+    def __new__(cls, saturation, production, failed, pressures=None, stats=()):
+        self = super().__new__(cls, (saturation, production))
+        self.failed = failed
+        self.pressures = pressures
+        self.stats = stats
+        return self
 
-    # Compose ensemble. This packing is a technicality necessary for
-    # the syntax of `map`, used instead of a `for`-loop for multiprocessing.
-    E = zip(*args)  # Tranpose args (so that member_index is 0th axis)
+    @property
+    def total(self):
+        return sum(filter(None, self.stats), Counter())
 
+def run_ens(nTime, *args, desc="", **kwargs):
+    """Run `run1` for each member, serially or in parallel. Returns a list."""
     # Dispatch jobs
     desc = " ".join(["Ens.simul.", desc])
-    if multiprocess:
-        from p_tqdm import p_map
-        n = None if isinstance(multiprocess, bool) else multiprocess
-        Ef = list(p_map(run1, list(E), num_cpus=n, desc=desc))
+    if multiprocess or cluster:
+        global pool
+        config = cache.fingerprint(model, dt, obs_inds, store_dtype, member_timeout,
+                                   retries, instrument, multiprocess, threads, cluster)
+        if pool is not None and pool.config != config:
+            pool.close()
+            pool = None
+        if pool is None:
+            n = None if isinstance(multiprocess, bool) else multiprocess
+            # Max. wait for any member (incl. its retries), with some slack
+            timeout = member_timeout and 2*(retries + 1)*member_timeout
+            if cluster:
+                pool = distributed.Coordinator(run1, cluster, n if multiprocess else 0,
+                                               timeout=timeout)
+                print("Start (remote) workers with:", pool.command(), sep="\n")
+            else:
+                Pool = parallel.ThreadPool if threads else parallel.Pool
+                pool = Pool(run1, n, timeout=timeout)
+            pool.config = config
+        # NB: the ensemble arrays are shared (not copied) with the workers
+        return pool.map(*args, nTime=nTime, desc=desc, **kwargs)
     else:
-        Ef = list(progbar(map(run1, E), desc, N))
+        # Compose ensemble. This packing is a technicality necessary for
+        # the syntax of `map`, used instead of a `for`-loop.
+        E = zip(*args)  # Tranpose args (so that member_index is 0th axis)
+        Ef = map(lambda x: run1(x, nTime, **kwargs), E)
+        return list(progbar(Ef, desc, len(args[0])))
+
+# Cache of the member simulations, keyed on their inputs (and the model configuration).
+# Thus, repeated runs (e.g. after the IES, or when re-running cells) cost nothing.
+# Set `directory` to also store them on disk (e.g. to persist between sessions).
+# The memory used is bounded by `maxbytes` (and the number of members by `maxsize`).
+# NB: changes to the code (e.g. of `perm_transf`) are not detected; use `memo.clear()`.
+memo = cache.LRUCache(maxsize=2000, directory=None, maxbytes=2**29)
+
+def forward_model(nTime, *args, desc="", snapshots=None, pressures=False):
+    """Create the (composite) forward model, i.e. forecast. Supports ensemble input.
+
+    Use `snapshots` to select which (time indices of the) saturation fields to return,
+    e.g. `[-1]` for the final state only, or `[]` for the production only.
+    This is done by each member run (also in the worker processes),
+    so that only what is needed is sent back.
+
+    Use `pressures=True` to also record the pressure solutions of each member
+    (in `Forecast.pressures`). These may then be passed (as `pressures`) to the
+    forecast of a similar ensemble (e.g. the next IES iteration), to be used as the
+    initial guesses of an iterative `model.solver`, i.e. for warm starts.
+    The number of solutions may differ between members (e.g. with `model.dMt_tol`),
+    so they are padded (at the end) to that of the longest, with NaNs. Missing ones
+    (e.g. for failed or cached members) are also NaN. The NaNs are not used.
+
+    Returns a `Forecast`.
+    """
+    seed = not isinstance(pressures, bool)  # i.e. an array
+
+    # Look up the members in the cache, and only run the others.
+    # NB: `retries` and `member_timeout` determine which members fail (see `run1`).
+    config = cache.fingerprint(model, dt, obs_inds, store_dtype, retries,
+                               member_timeout, nTime, snapshots)
+    keys = [cache.fingerprint(config, *member) for member in zip(*args)]
+    Ef = [memo.get(key) for key in keys]
+    todo = [n for n, out in enumerate(Ef) if out is None]
+    if todo:
+        inputs = args + (pressures,) if seed else args
+        new = run_ens(nTime, *[np.asarray(a)[todo] for a in inputs], desc=desc,
+                      snapshots=snapshots, pressures="seed" if seed else pressures)
+        for n, out in zip(todo, new):
+            Ef[n] = out
+            if not isinstance(out, Exception):
+                memo[keys[n]] = out[:2]
+
+    # Separate the extra outputs (see `run1`) of the members that were run (not cached)
+    extra = [Dict() if isinstance(out, Exception) or len(out) < 3 else out[2]
+             for out in Ef]
+    Ef = [out[:2] if isinstance(out, tuple) else out for out in Ef]
+
+    # Pressures (if requested)
+    P = None
+    if pressures is not False:
+        P = [x.get("pressures") for x in extra]
+        shapes = [p.shape for p in P if p is not None]
+        if shapes:
+            shape = max(shapes, key=len)
+            padded = np.full((len(P), max(s[0] for s in shapes), *shape[1:]), np.nan)
+            for n, p in enumerate(P):
+                if p is not None:
+                    padded[n, :len(p)] = p
+            P = padded
+        else:
+            P = None
+
+    # Instrumentation (if `instrument`)
+    stats = [x.get("stats") for x in extra]
+    sim_stats.update(sum(filter(None, stats), Counter()))
 
     # Transpose (to unpack)
-    # Here we output everything, but really we need only emit
+    # By default we output everything, but really we need only emit
     # - The state at the final time, for restarts (predictions).
     # - The observations (for the assimilation update).
     # - The variables used for production optimisation
     #   (in this case the same as the obs, namely the production).
+    # Use `snapshots` to restrict the output accordingly.
+    failed = {n: out for n, out in enumerate(Ef) if isinstance(out, Exception)}
+    if len(failed) == len(Ef):
+        raise RuntimeError("All members failed.") from failed[0]
+    if failed:
+        print(f"Warning: {len(failed)} member(s) failed:", *failed.items(), sep="\n")
+        ok = next(out for out in Ef if not isinstance(out, Exception))
+        nan = tuple(np.full_like(x, np.nan) for x in ok)
+        Ef = [nan if n in failed else out for n, out in enumerate(Ef)]
     saturation, production = zip(*Ef)
 
-    return np.array(saturation), np.array(production)
+    return Forecast(np.array(saturation), np.array(production), failed, P, stats)
 
 # Note that the forward model not only takes an ensemble of permeability fields, but
 # also an ensemble of initial water saturations. This is not because the initial
@@ -568,6 +747,7 @@ class ES_update:
 
     def __init__(self, obs_ens, observations, obs_err_cov):
         """Prepare the update."""
+        N           = len(obs_ens)
         Y, _        = center(obs_ens, rescale=True)
         obs_cov     = obs_err_cov*(N-1) + Y.T@Y
         obs_pert    = rnd.randn(N, len(observations)) @ sqrt(obs_err_cov)
@@ -593,16 +773,19 @@ def t_ravel(x, undo=False):
         *N, a, b = x.shape
         return x.reshape(N + [a*b])
 
+# Members whose simulation failed (if any, see `forward_model`) are dropped.
+ok = np.isfinite(t_ravel(prod.past.Prior)).all(axis=1)
+
 # Pre-compute
 ES = ES_update(
-    obs_ens      = t_ravel(prod.past.Prior),
+    obs_ens      = t_ravel(prod.past.Prior)[ok],
     observations = t_ravel(prod.past.Noisy),
     obs_err_cov  = sla.block_diag(*[R]*nTime),
 )
 # -
 
 # Apply
-perm.ES = ES(perm.Prior)
+perm.ES = ES(perm.Prior[ok])
 
 # #### Field plots
 # Let's plot the updated, initial ensemble.
@@ -666,19 +849,39 @@ def IES(ensemble, observations, obs_err_cov, stepsize=1, nIter=10, wtol=1e-4):
     # Init
     stat = Dict(dw=[], rmse=[], stepsize=[],
                 obj=Dict(lklhd=[], prior=[], postr=[]))
+    stat.kept = np.ones(N, bool)  # members (of the prior) not dropped
 
     # Init ensemble decomposition.
     X0, x0 = center(E)    # Decompose ensemble.
     w      = np.zeros(N)  # Control vector for the mean state.
     T      = np.eye(N)    # Anomalies transform matrix.
 
+    # Record the pressures, to warm-start (iterative) solvers in the next iteration.
+    pressures = model.solver not in ["direct", "banded"]
+
     for itr in range(nIter):
         # Compute rmse (vs. Truth)
         stat.rmse += [misc.RMSM(E, perm.Truth).rmse]
 
-        # Forecast.
-        _, Eo = forward_model(nTime, wsat.init.Prior, E, desc=f"Iter #{itr}")
-        Eo = t_ravel(Eo)
+        # Forecast. The final saturation is not needed here, but is kept (cached)
+        # for the re-run of the final iterate (in "Diagnostics", below).
+        forecast = forward_model(nTime, wsat.init.Prior[stat.kept], E,
+                                 desc=f"Iter #{itr}", snapshots=[-1],
+                                 pressures=pressures)
+        Eo = t_ravel(forecast[1])
+        P = forecast.pressures
+
+        # Drop members (of the prior) whose simulation failed.
+        failed = np.isnan(Eo).any(axis=1)
+        if itr == 0 and failed.any():
+            stat.kept = ~failed
+            E, Eo = E[~failed], Eo[~failed]
+            P = None if P is None else P[~failed]
+            N = len(E)
+            N1 = N - 1
+            X0, x0 = center(E)
+            w      = np.zeros(N)
+            T      = np.eye(N)
 
         # Prepare analysis.
         Y, xo  = center(Eo)         # Get anomalies, mean.
@@ -690,14 +893,17 @@ def IES(ensemble, observations, obs_err_cov, stepsize=1, nIter=10, wtol=1e-4):
         stat.obj.lklhd += [dy@dy]
         stat.obj.postr += [stat.obj.prior[-1] + stat.obj.lklhd[-1]]
 
-        reject_step = itr > 0 and stat.obj.postr[itr] > np.min(stat.obj.postr)
+        # NB: also rejects steps for which some member failed (postr is NaN).
+        reject_step = itr > 0 and not stat.obj.postr[itr] <= np.nanmin(stat.obj.postr)
         if reject_step:
             # Restore prev. ensemble, lower stepsize
             stepsize   /= 10
-            w, T        = old  # noqa
+            w, T, _     = old  # noqa
         else:
             # Store current ensemble, boost stepsize
-            old         = w, T
+            old         = w, T, E
+            if P is not None:
+                pressures = P  # i.e. warm starts from this iterate
             stepsize   *= 2
             stepsize    = min(1, stepsize)
 
@@ -715,8 +921,7 @@ def IES(ensemble, observations, obs_err_cov, stepsize=1, nIter=10, wtol=1e-4):
 
     # The last step must be discarded,
     # because it cannot be validated without re-running the model.
-    w, T = old
-    E = x0 + (w+T)@X0
+    w, T, E = old
 
     return E, stat
 
@@ -805,11 +1010,17 @@ plots.fields(perm_means, "pperm", "Means");
 # predicted and true *observations*), which we get from the predicted
 # production "profiles".
 
+# Only the final saturation is needed (for the restarts, below).
+# NB: the posterior ensembles are smaller than `N` if some prior members failed,
+# so the initial saturations are those of the members that were kept.
 (wsat.past.ES,
- prod.past.ES) = forward_model(nTime, wsat.init.Prior, perm.ES)
+ prod.past.ES) = forward_model(nTime, wsat.init.Prior[ok], perm.ES,
+                               snapshots=[-1])
 
+# NB: this was already simulated by the IES (and so is fetched from `memo`).
 (wsat.past.IES,
- prod.past.IES) = forward_model(nTime, wsat.init.Prior, perm.IES)
+ prod.past.IES) = forward_model(nTime, wsat.init.Prior[stats_IES.kept], perm.IES,
+                                snapshots=[-1])
 
 # It is Bayesian(ally) consistent to apply the pre-computed ES gain to any
 # un-conditioned ensemble, e.g. that of the prior's production predictions. This can be
@@ -818,7 +1029,7 @@ plots.fields(perm_means, "pperm", "Means");
 # the model again (in contrast to what we did for `prod.past.(I)ES` immediately above).
 # Since it requires 0 iterations, let's call this "ES0". Let us try that as well.
 
-prod.past.ES0 = t_ravel(ES(t_ravel(prod.past.Prior)), undo=True)
+prod.past.ES0 = t_ravel(ES(t_ravel(prod.past.Prior)[ok]), undo=True)
 
 # #### Production plots
 
@@ -894,7 +1105,7 @@ print("Future/prediction")
 (wsat.futr.IES,
  prod.futr.IES) = forward_model(nTime, wsat.curnt.IES, perm.IES)
 
-prod.futr.ES0 = t_ravel(ES(t_ravel(prod.futr.Prior)), undo=True)
+prod.futr.ES0 = t_ravel(ES(t_ravel(prod.futr.Prior)[ok]), undo=True)
 
 # #### Production plots
 
@@ -918,7 +1129,7 @@ misc.RMSMs(prod.futr, vs="Truth")
 
 def total_oil(E, rates):
     # bounded = np.all((0 < rates) & (rates < 1), axis=1)
-    wsat, prod = forward_model(nTime, *E, rates)
+    wsat, prod = forward_model(nTime, *E, rates, snapshots=[])
     return np.sum(prod, axis=(1, 2))
 
 # Define step modifier to improve on "vanilla" gradient descent.
@@ -946,7 +1157,7 @@ def EnOpt(obj, E, ctrls, C12, stepsize=1, nIter=10):
     # Diagnostics
     print("Initial controls:", ctrls)
     repeated = np.tile(ctrls, (N, 1))
-    J = obj(E, repeated).mean()
+    J = np.nanmean(obj(E, repeated))
     print("Total oil (mean) for initial guess: %.3f" % J)
 
     for _itr in progbar(range(nIter), desc="EnOpt"):
@@ -956,10 +1167,11 @@ def EnOpt(obj, E, ctrls, C12, stepsize=1, nIter=10):
         Ej = obj(E, Eu)
         # print("Total oil (mean): %.3f"%Ej.mean())
 
-        Xu = center(Eu)[0]
-        Xj = center(Ej)[0]
+        ok = np.isfinite(Ej)  # drop failed members
+        Xu = center(Eu[ok])[0]
+        Xj = center(Ej[ok])[0]
 
-        G  = Xj.T @ Xu / (N-1)
+        G  = Xj.T @ Xu / (sum(ok)-1)
 
         du = stepper(G)
         ctrls  = ctrls + stepsize*du
@@ -968,7 +1180,7 @@ def EnOpt(obj, E, ctrls, C12, stepsize=1, nIter=10):
     # Diagnostics
     print("Final controls:", ctrls)
     repeated = np.tile(ctrls, (N, 1))
-    J = obj(E, repeated).mean()
+    J = np.nanmean(obj(E, repeated))
     print("Total oil (mean) after optimisation: %.3f" % J)
 
     return ctrls
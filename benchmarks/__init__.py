@@ -0,0 +1,68 @@
+"""Benchmarks (wall times, throughput, memory), written to JSON for comparing versions.
+
+Run from the root of the repository, e.g.
+
+    python -m benchmarks.simulation --quick -o before.json
+
+and see `--help` for the options.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(fun, memory=True):
+    """Run `fun()`, and return its output, wall time, and peak memory (MB).
+
+    The memory is measured by a second run (since tracing slows it down),
+    using `tracemalloc`, which sees the allocations of numpy (and python),
+    but not those internal to compiled libraries (e.g. SuperLU).
+    """
+    t0 = time.perf_counter()
+    out = fun()
+    wall = time.perf_counter() - t0
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fun()
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return out, wall, peak
+
+
+def environment():
+    """Info on the versions (of code and libraries) and the machine."""
+    try:
+        commit = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(
+        commit=commit or None,
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=sys.version.split()[0],
+        numpy=np.__version__,
+        scipy=scipy.__version__,
+        machine=platform.platform(),
+        cpus=os.cpu_count(),
+    )
+
+
+def save(path, config, results, **extra):
+    """Write the `results` (list of dicts), `config` and `extra` to `path`, as JSON."""
+    data = dict(environment=environment(), config=config, results=results, **extra)
+    with open(path, "w") as F:
+        json.dump(data, F, indent=1, default=float)
+    print("Results written to", path)
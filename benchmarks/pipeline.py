@@ -0,0 +1,176 @@
+"""Benchmark the history matching workflow of `MAIN.py`, stage by stage.
+
+`MAIN.py` is run (headless) one section (`# ##` or `# ###` heading) at a time,
+recording for each stage (section with code) its wall time, and how much of it
+was spent in the `forward_model` (i.e. simulation), and the rest (e.g. the linear
+algebra of the analysis). The number of `forward_model` calls, and of members
+requested and actually simulated (i.e. not cached), are also counted,
+and the main functions (`sample_prior_perm`, `ES_update`, `IES`, `EnOpt`, ...)
+are timed.
+The simulator `stats` are also recorded (see `instrument` in `MAIN`).
+
+The plotting is disabled (unless `--plots`), so as to only time the computations.
+
+Example:
+    python -m benchmarks.pipeline --N 50 --grid 32 32 --nTime 20 -o bench.json
+"""
+
+import argparse
+import ast
+import functools
+import os
+import re
+import time
+from collections import Counter
+
+from benchmarks import ROOT, save
+
+# Functions of `MAIN` to time. They are wrapped as soon as they are defined,
+# and so are also timed when called from (other functions of) `MAIN`.
+PROFILED = ["sample_prior_perm", "forward_model", "run_ens", "ES_update",
+            "IES_analysis", "IES", "total_oil", "EnOpt"]
+
+
+def configure(src, **settings):
+    r"""Replace the values of the (top-level) assignments of `settings` in `src`.
+
+    The values are code, i.e. strings to be inserted verbatim.
+
+    >>> print(configure("N = 200\nM = N", N="10"))
+    N = 10
+    M = N
+    """
+    for name, value in settings.items():
+        src, n = re.subn(rf"^{name} = .*$", f"{name} = {value}", src, flags=re.M)
+        if n != 1:
+            raise ValueError(f"No (unique) top-level assignment of {name} in MAIN.py")
+    return src
+
+
+def sections(src):
+    """Split `src` by its `##` and `###` headings into `(title, line number, code)`.
+
+    The `code` is parsed (`ast`), with line numbers relative to all of `src`.
+    """
+    lines = src.splitlines(keepends=True)
+    starts = [0] + [i for i, ln in enumerate(lines) if re.match(r"# #{2,3} ", ln)]
+    ends = starts[1:] + [len(lines)]
+    for i0, i1 in zip(starts, ends):
+        title = lines[i0].lstrip("# ").strip()
+        # Pad with newlines, so that tracebacks show the right line numbers
+        yield title, i0 + 1, ast.parse("\n"*i0 + "".join(lines[i0:i1]))
+
+
+def disable_plotting(namespace):
+    """Replace the (figure producing) plotting functions by no-ops."""
+    from matplotlib import pyplot as plt
+
+    import simulator.plotting as plots
+
+    def noop(*args, **kwargs):
+        pass
+    for name in ["field", "fields", "field_interact", "productions", "production1",
+                 "dashboard", "spectrum"]:
+        setattr(plots, name, noop)
+
+    def freshfig(*args, **kwargs):
+        plt.close("all")
+        return plt.subplots()
+    namespace["freshfig"] = freshfig
+
+
+def profile(namespace, name, record):
+    """Wrap `namespace[name]` so as to `record` its number of calls and (total) time."""
+    fun = namespace[name]
+
+    @functools.wraps(fun)
+    def timed(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            record[name + ".calls"] += 1
+            record[name + ".time"] += time.perf_counter() - t0
+            if name == "forward_model":
+                record["members"] += len(args[1])
+            elif name == "run_ens":
+                record["simulated"] += len(args[1])
+    namespace[name] = timed
+
+
+def run(settings, plots=False):
+    """Run `MAIN.py` (with `settings`, see `configure`), recording each stage.
+
+    Returns the results of each stage, the timings of the `PROFILED` functions,
+    and the `sim_stats` of `MAIN`.
+    """
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    with open(os.path.join(ROOT, "MAIN.py")) as F:
+        src = configure(F.read(), **settings)
+
+    namespace = {"__name__": "__main__"}
+    record = Counter()
+    results = []
+    for title, line, code in sections(src):
+        if not code.body:
+            continue
+        before = record.copy()
+        t0 = time.perf_counter()
+        # Execute statement by statement, so as to wrap functions once defined
+        for stmt in code.body:
+            stmt = ast.Module([stmt], type_ignores=[])
+            exec(compile(stmt, os.path.join(ROOT, "MAIN.py"), "exec"), namespace)
+            if not plots:
+                disable_plotting(namespace)
+            for name in PROFILED:
+                if name in namespace and name + ".calls" not in record:
+                    record[name + ".calls"] = 0
+                    profile(namespace, name, record)
+        wall = time.perf_counter() - t0
+
+        delta = record - before
+        simulation = delta["forward_model.time"]
+        results.append(dict(
+            stage=title, line=line, wall=wall,
+            simulation=simulation, analysis=wall - simulation,
+            forward_model_calls=delta["forward_model.calls"],
+            members=delta["members"], simulated=delta["simulated"]))
+        print(f"{title[:40]:<40} {wall:8.2f}s (simulation: {simulation:8.2f}s)"
+              f" {delta['simulated']:6d} members simulated")
+
+    functions = {name: dict(calls=record[name + ".calls"], time=record[name + ".time"])
+                 for name in PROFILED}
+    sim_stats = dict(namespace.get("sim_stats", {}))
+    return results, functions, sim_stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--N", type=int, default=200, help="Ensemble size.")
+    parser.add_argument("--grid", type=int, nargs=2, default=[20, 20],
+                        metavar=("Nx", "Ny"), help="Grid size.")
+    parser.add_argument("--nTime", type=int, default=40,
+                        help="Number of (report) time steps.")
+    parser.add_argument("--multiprocess", type=int, default=0,
+                        help="Number of worker processes (see `MAIN`). 0: serial.")
+    parser.add_argument("--no-instrument", action="store_true",
+                        help="Do not record the simulator `stats` (see `MAIN`).")
+    parser.add_argument("--plots", action="store_true",
+                        help="Also (create and) time the plots.")
+    parser.add_argument("-o", "--output", default="bench-pipeline.json")
+    args = parser.parse_args(argv)
+
+    settings = dict(N=args.N, nTime=args.nTime, multiprocess=args.multiprocess or False,
+                    instrument=not args.no_instrument)
+    settings = {k: repr(v) for k, v in settings.items()}
+    settings["model"] = "simulator.ResSim(Nx={}, Ny={}, Lx=2, Ly=1)".format(*args.grid)
+    results, functions, sim_stats = run(settings, args.plots)
+
+    total = sum(r["wall"] for r in results)
+    simulation = sum(r["simulation"] for r in results)
+    print(f"{'Total':<40} {total:8.2f}s (simulation: {simulation:8.2f}s)")
+    save(args.output, vars(args), results, functions=functions, sim_stats=sim_stats)
+
+
+if __name__ == "__main__":
+    main()
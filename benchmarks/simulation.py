@@ -0,0 +1,178 @@
+"""Benchmark the simulator, over grid sizes, heterogeneity, and ensemble sizes.
+
+Benchmarks (`bench`) of the hot path, for each grid and permeability (`perm`):
+
+- `step`: `ResSim.step`, repeated `nTime` times.
+- `repeat`: same, but via `misc.repeat` (i.e. also storing states and observations).
+- `TPFA`: `ResSim.pressure_step` (i.e. `TPFA`), at the final state of `step`.
+- `saturation_step`: `ResSim.saturation_step`, likewise.
+- `serial`: ensemble forecast of `N` members, one at a time
+  (using `ResSim.with_params`), as done by `forward_model` (in `MAIN`).
+- `batched`: same, but all at once, using `ResSim.step_ensemble`.
+
+The ensembles whose total number of cells exceeds `--max-cells` are skipped.
+Note that the (explicit) transport substeps grow quickly with the grid resolution,
+so that the largest grids take minutes per step and member.
+
+The results include `steps_per_sec` (or calls, for `TPFA` and `saturation_step`),
+`members_per_sec`, `peak_mb` (see `benchmarks.measure`), `substeps` (the number
+of CFL-restricted transport steps per step), and the `stats` of `ResSim`.
+
+Example:
+    python -m benchmarks.simulation --grids 32 64 --N 1 100 -o bench.json
+"""
+
+import argparse
+from collections import Counter
+
+import numpy as np
+
+import simulator
+from benchmarks import measure, save
+from tools import geostat
+from tools.misc import repeat
+
+GRIDS = [20, 32, 64, 128, 256]
+ENSEMBLES = [1, 10, 100, 500]
+PERMS = ["homogeneous", "heterogeneous"]
+
+
+def setup(n, perm, N=1, seed=3000, **settings):
+    """Model on an `n x n` grid (with the wells of `MAIN`), and `N` permeabilities.
+
+    The heterogeneous log-permeabilities are sampled, and transformed, as by
+    `sample_prior_perm` and `perm_transf` in `MAIN`
+    (but using `geostat.gaussian_fields_fft`, which is also feasible for large grids).
+    """
+    model = simulator.ResSim(Nx=n, Ny=n, Lx=2, Ly=1)
+    grid1 = [.1, .9]
+    grid2 = np.dstack(np.meshgrid(grid1, grid1)).reshape((-1, 2))
+    model.config_wells([[.5, .5, 1]], np.hstack((grid2, np.ones((4, 1)))))
+    for key, val in settings.items():
+        setattr(model, key, val)
+
+    if perm == "homogeneous":
+        K = np.ones((N, 2, *model.shape))
+    else:
+        np.random.seed(seed)
+        x = geostat.gaussian_fields_fft(model.mesh(), N, r=0.8)
+        p = .1 + np.exp(5*x.reshape((N, *model.shape)))
+        K = np.stack([p, p], axis=1)
+    model.Gridded.K = K[0]
+    return model, K
+
+
+def benchmarks(model, K, Ns, nTime, dt, max_cells, memory=True):
+    """Yield the results of each benchmark (for the given `model` and `K`)."""
+    obs_inds = [model.xy2ind(x, y) for (x, y, _) in model.producers]
+    S0 = np.zeros(model.M)
+    state = {}
+
+    def run(bench, fun, N=1, calls=None):
+        stats, wall, peak = measure(fun, memory)
+        calls = calls or nTime
+        return dict(bench=bench, N=N, nTime=nTime, wall=wall,
+                    steps_per_sec=calls/wall, members_per_sec=N/wall, peak_mb=peak,
+                    substeps=stats["substeps"]/max(stats["steps"], 1),
+                    stats=dict(stats))
+
+    def step():
+        m = model.with_params()
+        m.stats = Counter()
+        S = S0
+        for _ in range(nTime):
+            S = m.step(S, dt)
+        state["S"] = S
+        return m.stats
+    yield run("step", step)
+
+    def repeat1():
+        m = model.with_params()
+        m.stats = Counter()
+        repeat(m.step, nTime, S0, dt, lambda S: S[obs_inds], pbar=False)
+        return m.stats
+    yield run("repeat", repeat1)
+
+    S = state["S"]
+    q = model.Q
+
+    def tpfa():
+        m = model.with_params()
+        m.stats = Counter()
+        for _ in range(nTime):
+            state["V"] = m.pressure_step(S, q)[1]
+        return m.stats
+    yield run("TPFA", tpfa)
+
+    def saturation_step():
+        m = model.with_params()
+        m.stats = Counter(steps=nTime)
+        for _ in range(nTime):
+            m.saturation_step(S, q, state["V"], dt)
+        return m.stats
+    yield run("saturation_step", saturation_step)
+
+    for N in Ns:
+        if N*model.M > max_cells:
+            print(f"Skipping N={N} (exceeds max_cells)")
+            continue
+        KN = np.resize(K, (N, *K.shape[1:]))  # cycle through the given fields
+
+        def serial(N=N, KN=KN):
+            stats = Counter()
+            for n in range(N):
+                m = model.with_params(K=KN[n])
+                m.stats = stats
+                repeat(m.step, nTime, S0, dt, lambda S: S[obs_inds], pbar=False)
+            return stats
+        yield run("serial", serial, N, N*nTime)
+
+        def batched(N=N, KN=KN):
+            m = model.with_params(K=KN)
+            m.stats = Counter()
+            repeat(m.step_ensemble, nTime, np.zeros((N, model.M)), dt,
+                   lambda E: E[..., obs_inds], pbar=False)
+            return m.stats
+        yield run("batched", batched, N, N*nTime)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--grids", type=int, nargs="+", default=GRIDS,
+                        help="Grid sizes (n, for n x n).")
+    parser.add_argument("--N", type=int, nargs="+", default=ENSEMBLES,
+                        help="Ensemble sizes.")
+    parser.add_argument("--perms", nargs="+", default=PERMS, choices=PERMS)
+    parser.add_argument("--nTime", type=int, default=10, help="Number of steps.")
+    parser.add_argument("--dt", type=float, default=0.025)
+    parser.add_argument("--solver", default="direct", help="See `simulator.solvers`.")
+    parser.add_argument("--transport", default="explicit")
+    parser.add_argument("--max-cells", type=float, default=1e6,
+                        help="Skip ensembles whose `N * Nx * Ny` exceeds this.")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Do not measure the peak memory (halves the run time).")
+    parser.add_argument("--quick", action="store_true",
+                        help="Only small grids and ensembles (for a smoke test).")
+    parser.add_argument("-o", "--output", default="bench-simulation.json")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.grids, args.N, args.nTime = [20, 32], [1, 10], 3
+
+    results = []
+    for n in args.grids:
+        for perm in args.perms:
+            nK = max([N for N in args.N if N*n*n <= args.max_cells], default=1)
+            model, K = setup(n, perm, nK, solver=args.solver, transport=args.transport)
+            for r in benchmarks(model, K, args.N, args.nTime, args.dt,
+                                args.max_cells, not args.no_memory):
+                r = dict(grid=f"{n}x{n}", perm=perm, **r)
+                results.append(r)
+                print("{grid:>7} {perm:>13} {bench:>15} N={N:<4} {wall:8.3f}s "
+                      "{steps_per_sec:9.1f} steps/s {substeps:6.0f} substeps"
+                      .format(**r))
+
+    save(args.output, vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,38 +8,149 @@ Implemented with OOP so as to facilitate multiple realisations, by ensuring
 that the parameter values of one instance do not influence another instance.
 Depending on thread-safety, this might not be necessary, but is usually cleaner
 when estimating anything other than the model's input/output (i.e. the state
-variables).
+variables). The instances derived by `ResSim.with_params` do not modify any shared
+state, and so may be run in concurrent threads.
 
 Note: Index ordering/labels: `x` is 1st coord., `y` is 2nd.
 See `grid.py` for more info.
 """
 
-from functools import wraps
+import copy
+import time
+from functools import lru_cache, wraps
 
 import numpy as np
 import scipy.sparse as sparse
 from numpy import errstate
+from numpy.linalg import norm
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 from scipy.sparse.linalg import spsolve
-# from scipy.sparse.linalg import cg
 from struct_tools import DotDict, NicePrint
 
+from simulator import solvers
 from simulator.grid import Grid2D
 
+try:
+    # Private (what `A @ x` uses under the hood), so may change with scipy versions
+    from scipy.sparse._sparsetools import csr_matvec
+except ImportError:
+    csr_matvec = None
+
 # TODO
 # - Protect Nx, Ny, shape, etc?
 # - Can the cell volumnes (h2) be arrays?
 
 
+@lru_cache(maxsize=16)
+def five_point_stencil(Nx, Ny, nEns=1, ordering=None):
+    """Sparsity pattern (CSR) of the 5-point stencil (diagonals `[-Ny, -1, 0, 1, Ny]`).
+
+    Only depends on the grid (and the number of stacked members), and so is cached.
+    Returns `indptr` and `indices`, as well as `src` (and `rows`), which map each entry
+    of the CSR `data` array to its position in the (flattened) stacked diagonals
+    (and its row). Entries that would couple cells across the domain boundaries
+    (or across members) are not included.
+
+    With `ordering="rcm"`, the rows and columns are (symmetrically) permuted
+    by the reverse Cuthill-McKee ordering, which reduces the bandwidth (and fill-in),
+    i.e. the pattern is that of `A[perm][:, perm]`, with `perm` also returned,
+    along with its inverse, `iperm`.
+
+    Example:
+    >>> pattern = five_point_stencil(2, 3)
+    >>> pattern.indptr
+    array([ 0,  3,  7, 10, 13, 17, 20], dtype=int32)
+    """
+    M = nEns*Nx*Ny
+    j = np.arange(M)  # column index
+    ix, iy = np.unravel_index(j % (Nx*Ny), (Nx, Ny))
+
+    # Following `spdiags`, the k-th diagonal (offset d) puts data[k, j] in row j-d.
+    # Here, the offsets are expressed by the (ix, iy) shift of the row vs. column.
+    shifts = [(1, 0), (0, 1), (0, 0), (0, -1), (-1, 0)]
+    rows, cols, src = [], [], []
+    for k, (dx, dy) in enumerate(shifts):
+        valid = (0 <= ix+dx) & (ix+dx < Nx) & (0 <= iy+dy) & (iy+dy < Ny)
+        rows.append(j[valid] + dx*Ny + dy)
+        cols.append(j[valid])
+        src .append(j[valid] + k*M)
+    rows, cols, src = map(np.concatenate, [rows, cols, src])
+
+    # Re-order
+    perm = iperm = None
+    if ordering == "rcm":
+        graph = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), (M, M))
+        perm = reverse_cuthill_mckee(graph, symmetric_mode=True)
+        iperm = np.argsort(perm)
+        rows, cols = iperm[rows], iperm[cols]
+    elif ordering is not None:
+        raise KeyError(f"Unknown ordering: {ordering!r}")
+
+    # Sort (row-major), and compress
+    order = np.lexsort((cols, rows))
+    idx = np.int32 if 5*M < np.iinfo(np.int32).max else np.int64
+    pattern = DotDict(
+        indptr  = np.r_[0, np.cumsum(np.bincount(rows, minlength=M))].astype(idx),
+        indices = cols[order].astype(idx),
+        src     = src[order],
+        rows    = rows[order],
+        shape   = (M, M),
+        perm    = perm,
+        iperm   = iperm,
+    )
+    pattern.diag = np.flatnonzero(pattern.rows == pattern.indices)
+    # Shared by all matrices (and models) => protect.
+    for v in pattern.values():
+        if isinstance(v, np.ndarray):
+            v.flags.writeable = False
+    return pattern
+
+
+def spmv(A, x, out):
+    """Sparse (CSR) matrix-vector product, `out = A @ x`, without allocations.
+
+    Falls back to `A @ x` if scipy's (private) `csr_matvec` is not available.
+
+    Example:
+    >>> A = sparse.random(5, 4, density=.5, format="csr", random_state=0)
+    >>> x = np.arange(4.)
+    >>> np.allclose(spmv(A, x, np.empty(5)), A @ x)
+    True
+    """
+    if csr_matvec is not None:
+        out.fill(0)
+        try:
+            csr_matvec(*A.shape, A.indptr, A.indices, A.data, x, out)
+            return out
+        except (TypeError, ValueError):
+            pass  # changed signature
+    out[:] = A @ x
+    return out
+
+
 class ResSim(NicePrint, Grid2D):
     """Reservoir simulator.
 
     Example:
+    >>> from tools.misc import repeat
     >>> model = ResSim(Lx=1, Ly=1, Nx=32, Ny=32)
     >>> model.config_wells([[0, 0, 1]], [[1, 1, -1]])
     >>> water_sat0 = np.zeros(model.M)
-    >>> saturation = repeat(model.step, 3, water_sat0, 0.025)
+    >>> saturation = repeat(model.step, 3, water_sat0, 0.025, pbar=False)
     >>> saturation[-1, :3]
     array([0.9884098 , 0.97347222, 0.95294563])
+
+    Ensembles (stacked along the 1st axis) can be stepped all at once,
+    with the same results as stepping each member on its own:
+    >>> K = np.exp(np.random.RandomState(0).randn(2, *model.Gridded.K.shape))
+    >>> E = repeat(model.with_params(K=K).step_ensemble, 3, np.zeros((2, model.M)),
+    ...            0.025, pbar=False)
+    >>> E.shape
+    (4, 2, 1024)
+    >>> E1 = [repeat(model.with_params(K=Kn).step, 3, water_sat0, 0.025, pbar=False)
+    ...       for Kn in K]
+    >>> np.abs(E - np.stack(E1, axis=1)).max() < 1e-12
+    True
     """
 
     @wraps(Grid2D.__init__)
@@ -59,6 +170,50 @@ class ResSim(NicePrint, Grid2D):
             swc=0.0, sor=0.0,  # Irreducible saturations
         )
 
+        # Transport scheme: "explicit" or "implicit".
+        self.transport = "explicit"
+
+        # Pressure solver: name (see `solvers.solvers`) or function.
+        self.solver = "direct"
+        # Ordering of the pressure system: None or "rcm" (see `five_point_stencil`).
+        # Computed once per grid. Mainly useful with the "banded" solver.
+        self.ordering = None
+
+        # Max. saturation change per internal time step, e.g. 0.2.
+        # If None, the internal step is the report step, `dt`, of `self.step`.
+        self.dS_tol = None
+
+        # Max. relative change in total mobility before re-solving pressure, e.g. 0.05.
+        # If None, pressure is solved at every internal time step.
+        self.dMt_tol = None
+
+        # Pressure solutions (e.g. of a previous run, with similar parameters)
+        # to use in turn, rather than the last solution, as initial guesses for
+        # the (iterative) pressure solver. An iterator (or None). See `TPFA`.
+        self.pressure_guesses = None
+        # If a list, the pressure solutions are appended to it.
+        self.pressure_log = None
+
+        # Instrumentation: set to a `collections.Counter` to accumulate the wall times
+        # (`t_*`) of the phases of the time stepping, and counts (`steps`, `substeps`,
+        # pressure `solves`, solver `iters`, matrix `nnz`, ...). See `lap` and `count`.
+        self.stats = None
+
+        # Abort (with `TimeoutError`) once `time.monotonic()` exceeds this.
+        # Checked (cooperatively) during the time stepping. See `check`.
+        self.deadline = None
+
+        # Derived from `Gridded.K`. See `self.perm_cache`.
+        self._perm = DotDict(K=None)
+
+        # Carried over from one time step to the next.
+        self._last = DotDict(
+            u  = None,  # pressure solution (for warm starts)
+            dt = None,  # internal step size (for adaptive stepping)
+            V  = None,  # fluxes (for lagged pressure) and what they were computed with:
+            Mt = None, L=None, Q=None,
+        )
+
     def config_wells(self, inj, prod, remap=True):
         """Scale production so as to equal injection.
 
@@ -98,94 +253,223 @@ class ResSim(NicePrint, Grid2D):
         self.injectors = inj
         self.producers = prod
 
+    def check(self, S=None):
+        """Raise if past the `deadline`, or if (the saturation) `S` has diverged."""
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeoutError("Simulation exceeded its deadline.")
+        if S is not None and not np.isfinite(S).all():
+            raise FloatingPointError("Non-finite saturation.")
+
+    def clock(self):
+        """Get the time (only if instrumented, see `stats`)."""
+        return None if self.stats is None else time.perf_counter()
+
+    def lap(self, phase, t0):
+        """Add the time since `t0` to `stats["t_" + phase]`, and return the time."""
+        if self.stats is None:
+            return None
+        t = time.perf_counter()
+        self.stats["t_" + phase] += t - t0
+        return t
+
+    def count(self, key, n=1):
+        """Add `n` to `stats[key]` (if instrumented)."""
+        if self.stats is not None:
+            self.stats[key] += n
+
     def spdiags(self, data, diags):
-        return sparse.spdiags(data, diags, self.M, self.M)
+        # NB: size taken from data, which may hold a (flattened) ensemble
+        M = np.shape(data)[-1]
+        return sparse.spdiags(data, diags, M, M)
+
+    def stencil(self, S, ordering=None):
+        """Get the (cached) `five_point_stencil` for the (ensemble of) states `S`."""
+        return five_point_stencil(self.Nx, self.Ny, np.size(S)//self.M, ordering)
+
+    def assemble(self, DiagVecs, ordering=None):
+        """Like `self.spdiags(DiagVecs, [-Ny, -1, 0, 1, Ny]).tocsr()`, but faster.
+
+        Only the `data` array is computed, the rest of the CSR matrix is re-used.
+        NB: unlike `spdiags`, it omits the (zero, in `TPFA`) entries coupling cells
+        across the domain boundaries (and members).
+
+        Example (for an ensemble of 2):
+        >>> model = ResSim(Nx=7, Ny=5)
+        >>> D = np.random.RandomState(0).rand(5, 2*model.M)
+        >>> A = model.assemble(D)
+        >>> B = model.spdiags(D, [-model.Ny, -1, 0, 1, model.Ny]).tocsr()
+        >>> abs(A - B.multiply(A != 0)).max() == 0
+        True
+        >>> p = model.stencil(D[2], "rcm").perm
+        >>> abs(model.assemble(D, "rcm") - A[p][:, p]).max() == 0
+        True
+        """
+        pattern = self.stencil(DiagVecs[2], ordering)
+        data = np.concatenate(DiagVecs).take(pattern.src)
+        return sparse.csr_matrix((data, pattern.indices, pattern.indptr),
+                                 pattern.shape, copy=False)
+
+    def RelPerm(self, s, deriv=False, out=None):
+        """Rel. permeabilities of oil and water. Optionally also their derivatives.
 
-    def RelPerm(self, s):
-        """Rel. permeabilities of oil and water."""
+        If `out` (a pair of arrays) is provided, the mobilities are written to it,
+        without allocating any temporary arrays (but derivatives are not available).
+        """
         Fluid = self.Fluid
+        if out is not None:
+            Mw, Mo = out
+            np.subtract(s, Fluid.swc, out=Mw)
+            Mw /= (1-Fluid.swc-Fluid.sor)  # Rescale saturations
+            np.subtract(1, Mw, out=Mo)
+            Mo *= Mo
+            Mo /= Fluid.vo
+            Mw *= Mw
+            Mw /= Fluid.vw
+            return Mw, Mo
         S = (s-Fluid.swc)/(1-Fluid.swc-Fluid.sor)  # Rescale saturations
         Mw = S**2/Fluid.vw  # Water mobility
         Mo = (1-S)**2/Fluid.vo  # Oil mobility
-        # Derivatives:
-        # dMw = 2*S/Fluid.vw/(1-Fluid.swc-Fluid.sor)
-        # dMo = -2*(1-S)/Fluid.vo/(1-Fluid.swc-Fluid.sor)
+        if deriv:
+            dMw = 2*S/Fluid.vw/(1-Fluid.swc-Fluid.sor)
+            dMo = -2*(1-S)/Fluid.vo/(1-Fluid.swc-Fluid.sor)
+            return Mw, Mo, dMw, dMo
         return Mw, Mo
 
     def upwind_diff(self, V, q):
         """Upwind finite-volume scheme."""
-        fp = q.clip(max=0)  # production
+        t0 = self.clock()
+        fp = q.clip(max=0).ravel()  # production
         # Flow fluxes, separated into direction (x-y) and sign
-        x1 = V.x.clip(max=0)[:-1, :].ravel()
-        x2 = V.x.clip(min=0)[1:, :] .ravel()
-        y1 = V.y.clip(max=0)[:, :-1].ravel()
-        y2 = V.y.clip(min=0)[:, 1:] .ravel()
+        x1 = V.x.clip(max=0)[..., :-1, :].ravel()
+        x2 = V.x.clip(min=0)[..., 1:, :] .ravel()
+        y1 = V.y.clip(max=0)[..., :, :-1].ravel()
+        y2 = V.y.clip(min=0)[..., :, 1:] .ravel()
         # Compose flow matrix
         DiagVecs = [x2, y2, fp+y1-y2+x1-x2, -y1, -x1]      # noqa diagonal vectors
-        DiagIndx = [-self.Ny, -1,        0,  1,  self.Ny]  # noqa diagonal index
+        # DiagIndx = [-self.Ny, -1,      0,  1,  self.Ny]  # noqa diagonal index
         # Matrix with upwind FV stencil
-        A = self.spdiags(DiagVecs, DiagIndx)
+        A = self.assemble(DiagVecs)
+        self.lap("upwind", t0)
         return A
 
-    def TPFA(self, K, q):
+    def perm_cache(self):
+        """Get the quantities that only depend on `Gridded.K`.
+
+        They are computed once, and re-used until `Gridded.K` is re-assigned,
+        or modified in-place (detected by comparison with a private copy).
+        """
+        cache = self._perm
+        K = self.Gridded.K
+        if cache.K is not K or not np.array_equal(cache.K_copy, K):
+            cache.clear()
+            cache.K = K
+            cache.K_copy = np.array(K)
+            cache.L = K**(-1)
+            # For coercion to SPD. NB: K[..., 0, 0] of each member.
+            cache.K0 = np.ravel(np.sum(K[..., :, 0, 0], axis=-1))
+        return cache
+
+    def TPFA(self, K, q, L=None):
         """Two-point flux-approximation (TPFA) of Darcy:
 
         diffusion w/ nonlinear coefficient K.
+        Alternatively, its inverse (`L = K**(-1)`) may be provided (in which case
+        `K` is not used, and may be `None`).
+
+        If `K` has a leading (ensemble) axis, the members' systems are
+        assembled (and solved) as a single block-diagonal system.
+        This works because the stencil coefficients that would couple
+        neighbouring members (across the domain boundaries) are zero.
         """
+        t0 = self.clock()
+        if L is None:
+            L = K**(-1)
+        ens = L.shape[:-3]  # ensemble shape (if any)
+
         # Compute transmissibilities by harmonic averaging.
-        L = K**(-1)
-        TX = np.zeros((self.Nx+1, self.Ny))
-        TY = np.zeros((self.Nx,   self.Ny+1))  # noqa
+        TX = np.zeros(ens + (self.Nx+1, self.Ny))
+        TY = np.zeros(ens + (self.Nx,   self.Ny+1))  # noqa
 
-        TX[1:-1, :] = 2*self.hy/self.hx/(L[0, :-1, :] + L[0, 1:, :])
-        TY[:, 1:-1] = 2*self.hx/self.hy/(L[1, :, :-1] + L[1, :, 1:])
+        TX[..., 1:-1, :] = 2*self.hy/self.hx/(L[..., 0, :-1, :] + L[..., 0, 1:, :])
+        TY[..., :, 1:-1] = 2*self.hx/self.hy/(L[..., 1, :, :-1] + L[..., 1, :, 1:])
 
         # Assemble TPFA discretization matrix.
-        x1 = TX[:-1, :].ravel()
-        x2 = TX[1:, :] .ravel()
-        y1 = TY[:, :-1].ravel()
-        y2 = TY[:, 1:] .ravel()
+        x1 = TX[..., :-1, :].ravel()
+        x2 = TX[..., 1:, :] .ravel()
+        y1 = TY[..., :, :-1].ravel()
+        y2 = TY[..., :, 1:] .ravel()
 
         # Setup linear system
         DiagVecs = [-x2,      -y2, y1+y2+x1+x2, -y1,     -x1]  # noqa
-        DiagIndx = [-self.Ny,  -1,      0,   1,      self.Ny]  # noqa
+        # DiagIndx = [-self.Ny, -1,      0,   1,      self.Ny]  # noqa
         # Coerce system to be SPD (ref article, page 13).
-        DiagVecs[2][0] += np.sum(self.Gridded.K[:, 0, 0])
-        A = self.spdiags(DiagVecs, DiagIndx)
+        DiagVecs[2].reshape(-1, self.M)[:, 0] += self.perm_cache().K0
+        A = self.assemble(DiagVecs, self.ordering)
+        t0 = self.lap("assemble", t0)
 
-        # Solve
+        # Solve, warm-starting from the previous solution (or the provided guess)
         # u = np.linalg.solve(A.A, q)  # direct dense solver
-        u = spsolve(A.tocsr(), q)  # direct sparse solver
-        # u, _info = cg(A, q)  # conjugate gradient
-        # Could also try scipy.linalg.solveh_banded which, according to
-        # https://scicomp.stackexchange.com/a/30074 uses the Thomas algorithm,
-        # as recommended by Aziz and Settari ("Petro. Res. simulation").
-        # NB: stackexchange also mentions that solve_banded does not work well
-        # when the band offsets large, i.e. higher-dimensional problems.
+        solve = solvers.get(self.solver)
+        b = q.ravel()
+        u0 = [self._last.u]
+        if self.pressure_guesses is not None:
+            u0.append(next(self.pressure_guesses, None))
+        u0 = [u for u in u0 if u is not None and u.size == b.size]
+        if self.ordering:
+            pattern = self.stencil(b, self.ordering)
+            b = b[pattern.perm]
+            u0 = [u[pattern.perm] for u in u0]
+        if len(u0) > 1:
+            u0.sort(key=lambda u: norm(b - A@u))  # use the best (smallest residual)
+        u0 = u0[0] if u0 else None
+        solvers.info.iters = 0
+        u = solve(A, b, u0)
+        self.lap("solve", t0)
+        self.count("solves")
+        self.count("iters", solvers.info.iters)
+        self.count("nnz", A.nnz)
+        if self.ordering:
+            u = u[pattern.iperm]
+        self._last.u = u
+        if self.pressure_log is not None:
+            self.pressure_log.append(u)
 
         # Extract fluxes
-        P = u.reshape(self.shape)
+        P = u.reshape(ens + self.shape)
         V = DotDict(
-            x = np.zeros((self.Nx+1, self.Ny)),
-            y = np.zeros((self.Nx,   self.Ny+1)),  # noqa
+            x = np.zeros(ens + (self.Nx+1, self.Ny)),
+            y = np.zeros(ens + (self.Nx,   self.Ny+1)),  # noqa
         )
-        V.x[1:-1, :] = (P[:-1, :] - P[1:, :]) * TX[1:-1, :]
-        V.y[:, 1:-1] = (P[:, :-1] - P[:, 1:]) * TY[:, 1:-1]
+        V.x[..., 1:-1, :] = (P[..., :-1, :] - P[..., 1:, :]) * TX[..., 1:-1, :]
+        V.y[..., :, 1:-1] = (P[..., :, :-1] - P[..., :, 1:]) * TY[..., :, 1:-1]
         return P, V
 
     def pressure_step(self, S, q):
         """TPFA finite-volume of Darcy: -nabla(K lambda(s) nabla(u)) = q."""
-        # Compute K*lambda(S)
+        # Compute (K*lambda(S))**(-1), using the cached K**(-1)
         Mw, Mo = self.RelPerm(S)
         Mt = Mw+Mo
-        Mt = Mt.reshape(self.shape)
-        KM = Mt*self.Gridded.K
+        Mt = Mt.reshape(S.shape[:-1] + (1,) + self.shape)  # 1 for x&y dirs.
+        L = self.perm_cache().L / Mt
         # Compute pressure and extract fluxes
-        [P, V] = self.TPFA(KM, q)
+        [P, V] = self.TPFA(None, q, L=L)
         return P, V
 
     def saturation_step(self, S, q, V, T):
-        """Explicit upwind finite-volume discretisation of CoM."""
+        """Transport step, using the scheme selected by `self.transport`."""
+        if self.transport == "implicit":
+            return self.saturation_step_implicit(S, q, V, T)
+        return self.saturation_step_explicit(S, q, V, T)
+
+    def saturation_step_explicit(self, S, q, V, T):
+        """Explicit upwind finite-volume discretisation of CoM.
+
+        With an ensemble, the number of (CFL-restricted) local time steps
+        is computed for each member, and members are frozen once they're done.
+
+        The (possibly thousands of) local time steps are computed in place,
+        using pre-allocated work arrays.
+        """
         pv = self.h2*self.Gridded['por'].ravel()  # pore volume=cell volume*porosity
 
         fi = q.clip(min=0)    # inflow from wells
@@ -195,33 +479,205 @@ class ResSim(NicePrint, Grid2D):
         YP = V.y.clip(min=0)
         YN = V.y.clip(max=0)  # influx and outflux, y-faces
 
-        Vi = XP[:-1]-XN[1:]+YP[:, :-1]-YN[:, 1:]  # each gridblock
+        Vi = XP[..., :-1, :]-XN[..., 1:, :]+YP[..., :-1]-YN[..., 1:]  # each gridblock
 
         # Compute dt
         with errstate(divide="ignore"):
-            pm = min(pv/(Vi.ravel()+fi))      # estimate of influx
+            pm = np.min(pv/(Vi.reshape(S.shape)+fi), -1)  # estimate of influx
         sat = self.Fluid.swc + self.Fluid.sor
         # CFL restriction NB: 3-->2 since no z-dim ?
         cfl = ((1-sat)/3)*pm
-        Nts = int(np.ceil(T/cfl))             # number of local time steps
-        dtx = (T/Nts)/pv                      # local time steps
+        if np.isnan(cfl).any():
+            raise FloatingPointError("Non-finite fluxes.")
+        Nts = np.ceil(T/cfl).astype(int)      # number of local time steps
+        dtx = (T/Nts)[..., None]/pv           # local time steps
 
         # Discretized transport operator
         A = self.upwind_diff(V, q)           # system matrix
-        A = self.spdiags(dtx, 0)@A           # A * dt/|Omega i|
-
-        for _iT in range(Nts):
-            mw, mo = self.RelPerm(S)         # compute mobilities
-            fw = mw/(mw+mo)                  # compute fractional flow
-            S = S + (A@fw + fi*dtx)          # update saturation
-
+        A.data *= dtx.ravel()[self.stencil(S).rows]  # A * dt/|Omega i|
+
+        # Work arrays
+        shape = S.shape
+        S = np.array(S, float).ravel()      # NB: copy (not to modify input)
+        mw, mo, fw, dS = np.empty((4, S.size))
+        fidtx = (fi*dtx).ravel()
+
+        t0 = self.clock()
+        self.count("substeps", np.max(Nts))
+        for iT in range(np.max(Nts)):
+            if iT % 1000 == 999:
+                self.check()                 # e.g. very many steps
+            self.RelPerm(S, out=(mw, mo))    # compute mobilities
+            np.add(mw, mo, out=fw)
+            np.divide(mw, fw, out=fw)        # compute fractional flow
+            spmv(A, fw, out=dS)
+            dS += fidtx
+            if iT >= np.min(Nts):
+                # freeze members that are done
+                dS.reshape(shape)[...] *= (iT < Nts)[..., None]
+            S += dS                          # update saturation
+
+        self.lap("transport", t0)
+        return S.reshape(shape)
+
+    def saturation_step_implicit(self, S, q, V, T, tol=1e-3, maxit=10, maxhalv=12):
+        """Implicit (backward Euler) upwind finite-volume discretisation of CoM.
+
+        The nonlinear system is solved by Newton-Raphson (`NewtRaph` of ref article).
+        There is no CFL restriction, but if Newton's method does not converge
+        (within `maxit` iterations, to `tol`), the time step is halved.
+        """
+        pv = self.h2*self.Gridded['por'].ravel()  # pore volume=cell volume*porosity
+        pattern = self.stencil(S)
+        A = self.upwind_diff(V, q)           # system matrix
+        S00 = S
+        t0 = self.clock()
+
+        for IT in range(maxhalv):
+            dt  = T/2**IT
+            dtx = np.broadcast_to(dt/pv, S.shape)
+            fi  = q.clip(min=0)*dtx          # inflow from wells
+            B = A.copy()
+            B.data *= dtx.ravel()[pattern.rows]  # A * dt/|Omega i|
+
+            S = S00
+            for _I in range(2**IT):
+                S0 = S
+                for _it in range(maxit):
+                    self.check()
+                    self.count("newton")
+                    Mw, Mo, dMw, dMo = self.RelPerm(S, deriv=True)
+                    Mt = Mw + Mo
+                    fw = Mw/Mt                       # fractional flow
+                    df = dMw/Mt - Mw/Mt**2*(dMw+dMo)  # its derivative
+                    # Residual and Jacobian: G = S-S0-(B*fw+fi), dG = I-B*diag(df)
+                    G = S - S0 - ((B@fw.ravel()).reshape(S.shape) + fi)
+                    dG = B.copy()
+                    dG.data *= -df.ravel()[pattern.indices]
+                    dG.data[pattern.diag] += 1
+                    ds = -spsolve(dG, G.ravel()).reshape(S.shape)
+                    # Update, keeping within physical bounds (helps convergence)
+                    S = (S + ds).clip(self.Fluid.swc, 1-self.Fluid.sor)
+                    dsn = np.max(norm(ds, axis=-1))  # worst member
+                    if dsn < tol:
+                        break
+                else:
+                    break  # not converged => halve dt (for all members)
+            else:
+                self.lap("transport", t0)
+                self.count("substeps", 2**IT)
+                return S
+
+        raise RuntimeError("Newton's method did not converge (implicit transport).")
+
+    def impes_step(self, S, q, dt):
+        """Solve pressure (implicitly), then saturation (explicitly or implicitly).
+
+        If `self.dMt_tol` is set, the pressure is only re-solved if the total mobility
+        has changed (in relative norm, for any member) by more than `dMt_tol`
+        since the last solve. Otherwise the previous fluxes are re-used.
+        """
+        self.count("steps")
+        if not self.dMt_tol:
+            [P, V] = self.pressure_step(S, q)
+        else:
+            last = self._last
+            Mt = np.add(*self.RelPerm(S))
+            if (last.V is not None and last.Mt.shape == Mt.shape
+                    and last.L is self.perm_cache().L and last.Q is self.Q
+                    and np.max(norm(Mt - last.Mt, axis=-1) /
+                               norm(last.Mt, axis=-1)) <= self.dMt_tol):
+                V = last.V
+            else:
+                [P, V] = self.pressure_step(S, q)
+                last.update(V=V, Mt=Mt, L=self.perm_cache().L, Q=self.Q)
+        S = self.saturation_step(S, q, V, dt)
         return S
 
     def step(self, S, dt):
-        [P, V] = self.  pressure_step(S, self.Q)
-        S      = self.saturation_step(S, self.Q, V, dt)
+        """Advance saturation `S` by (report) time step `dt`.
+
+        If `self.dS_tol` is set, the internal (IMPES) time steps are chosen adaptively,
+        such that the saturation does not change more than `dS_tol` (in any cell)
+        per internal step. Steps exceeding this are rejected and retried.
+        The step size is then grown (or shrunk) towards the tolerance,
+        and remembered for the next call.
+
+        Raises if the saturation diverges, or the `deadline` is exceeded (see `check`).
+        """
+        S = np.asarray(S, float)  # double precision, even if stored in single
+        q = np.broadcast_to(self.Q, S.shape)
+        if not self.dS_tol:
+            S = self.impes_step(S, q, dt)
+            self.check(S)
+            return S
+
+        t, h = 0, self._last.dt or dt
+        while t < dt:
+            final = h >= dt - t
+            hh = dt - t if final else h
+            S1 = self.impes_step(S, q, hh)
+            self.check(S1)
+            dS = np.max(abs(S1 - S))
+            factor = 0.9*self.dS_tol/max(dS, 1e-8)
+            if dS > self.dS_tol:
+                h = hh*max(factor, 0.1)  # reject
+                continue
+            S = S1
+            t = dt if final else t + hh
+            if not final:
+                h = hh*min(factor, 2)
+        self._last.dt = h
         return S
 
+    def step_ensemble(self, E, dt):
+        """Like `step`, but for an ensemble of saturations, `E.shape == (N, M)`.
+
+        All members are stepped at once, i.e. the (block-diagonal) pressure system
+        is assembled and solved only once, and the transport is vectorized.
+        The permeabilities are those of `self.Gridded.K`, which may also be
+        specified per member, i.e. `K.shape == (N, 2, Nx, Ny)`, e.g. by
+        `model.with_params(K=K)`. Do so once (not per step), so that the
+        state (lagged pressure, time step, cached transmissibilities) is kept.
+        """
+        return self.step(np.atleast_2d(E), dt)
+
+    def with_params(self, K=None, rates=None):
+        """Derive a (member) model from this (template) one, with new parameters.
+
+        Much cheaper than `copy.deepcopy(self)`: the grid, fluid, (unchanged) wells,
+        and settings are shared, while the per-member data (`Gridded`, `Q`, and the
+        carried-over state and caches) are new, making the members independent.
+        The `pressure_guesses`, `pressure_log` and `stats` are reset.
+
+        - `K`: permeability, i.e. `Gridded.K` (otherwise the template's is used).
+        - `rates`: production rates, i.e. `producers[:, 2]` (before normalisation).
+
+        NB: the attributes of the member may be re-assigned (e.g. `Gridded.K = ...`),
+        but should not be modified in-place, since that would affect the template.
+
+        Example:
+        >>> model = ResSim(Lx=1, Ly=1, Nx=4, Ny=4)
+        >>> model.config_wells([[0, 0, 1]], [[1, 1, 1], [0, 1, 1]])
+        >>> member = model.with_params(K=2*model.Gridded.K, rates=[3, 1])
+        >>> member.producers[:, 2], model.producers[:, 2]
+        (array([0.75, 0.25]), array([0.5, 0.5]))
+        >>> member.Gridded.por is model.Gridded.por
+        True
+        """
+        model = copy.copy(self)
+        model.Gridded = DotDict(self.Gridded)
+        model._perm = DotDict(K=None)
+        model._last = DotDict.fromkeys(self._last)
+        model.pressure_guesses = model.pressure_log = model.stats = None
+        if K is not None:
+            model.Gridded.K = K
+        if rates is not None:
+            prod = self.producers.copy()
+            prod[:, 2] = rates
+            model.config_wells(self.injectors.copy(), prod, remap=False)
+        return model
+
 
 # Example run
 if __name__ == '__main__':
@@ -263,6 +719,8 @@ if __name__ == '__main__':
     # but I find that dt=0.1 works alright too.
     # With 32x32 I find that dt=0.2 works fine.
     # With 20x20 I find that dt=0.4 works fine.
+    # Alternatively, let the model choose (and vary) its internal time steps:
+    # model.dS_tol = 0.2
     T = 28*0.025
     dt = 0.4
     nTime = round(T/dt)
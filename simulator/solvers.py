@@ -0,0 +1,169 @@
+"""Linear solvers for the (SPD) pressure system of `ResSim.TPFA`.
+
+Each solver has the signature `solve(A, b, x0=None)`, with `A` in CSR format,
+and returns the solution `x`. The initial guess `x0` (typically the pressure
+from the previous time step) is ignored by the direct solvers, but can greatly
+speed up the iterative ones, because the pressure changes only slowly
+(through the mobilities).
+
+Select the solver for a model by name (`model.solver = "cg"`),
+or by providing your own function (`model.solver = my_solver`).
+Parameters can be changed using `functools.partial`.
+For large grids, `"amg"` (requires `pyamg`) is typically the fastest iterative solver,
+but `"direct"` remains competitive up to at least `128x128`.
+
+Example:
+>>> A = sparse.diags([-np.ones(9), 2*np.ones(10), -np.ones(9)], [-1, 0, 1]).tocsr()
+>>> b = np.ones(10)
+>>> x = solvers["direct"](A, b)
+>>> np.allclose(solvers["cg"](A, b, x0=x+.1), x)
+True
+"""
+
+import inspect
+import threading
+
+import numpy as np
+import scipy.linalg as sla
+import scipy.sparse as sparse
+import scipy.sparse.linalg as ssl
+
+solvers = {}
+
+# Info on the last solve (of the current thread): number of `iters` (if iterative).
+info = threading.local()
+
+
+def register(name):
+    """Decorator to add solver to the registry."""
+    def decorator(solve):
+        solvers[name] = solve
+        return solve
+    return decorator
+
+
+# scipy>=1.12 renamed `tol` to `rtol` (for the iterative solvers).
+_RTOL = "rtol" if "rtol" in inspect.signature(ssl.cg).parameters else "tol"
+
+
+@register("direct")
+def direct(A, b, x0=None):
+    """Sparse LU (SuperLU), with (COLAMD) fill-reducing ordering."""
+    return ssl.spsolve(A, b)
+
+
+@register("banded")
+def banded(A, b, x0=None):
+    """Cholesky for banded matrices (LAPACK `pbsv`).
+
+    Recommended by Aziz and Settari ("Petro. Res. simulation"),
+    but note that the band is wide (`Ny`) for 2D problems,
+    see https://scicomp.stackexchange.com/a/30074 .
+    Use `ResSim.ordering = "rcm"` to reduce it to `min(Nx, Ny)`.
+    """
+    A = A.tocoo()
+    upper = A.col >= A.row
+    i, j = A.row[upper], A.col[upper]
+    u = np.max(j - i)
+    # Upper form: ab[u + i - j, j] == A[i, j]
+    ab = np.zeros((u+1, A.shape[1]))
+    ab[u + i - j, j] = A.data[upper]
+    return sla.solveh_banded(ab, b)
+
+
+def jacobi(A):
+    """Diagonal preconditioner."""
+    return sparse.diags(1/A.diagonal())
+
+
+def ilu(A, drop_tol=1e-4, fill_factor=10):
+    """Incomplete LU preconditioner.
+
+    NB: not symmetric, and so not suitable for CG or MINRES.
+    """
+    factor = ssl.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor)
+    return ssl.LinearOperator(A.shape, factor.solve)
+
+
+def amg(A):
+    """Algebraic multigrid (smoothed aggregation) preconditioner. Requires `pyamg`."""
+    import pyamg  # optional dependency
+    return pyamg.smoothed_aggregation_solver(A, symmetry="symmetric").aspreconditioner()
+
+
+def krylov(method, A, b, x0=None, precond=jacobi, rtol=1e-10, maxiter=None,
+           fallback=None):
+    """Preconditioned Krylov solver, e.g. `scipy.sparse.linalg.cg`.
+
+    If the `method` breaks down (`info < 0`), the `fallback` solver is used, if any.
+    """
+    if x0 is not None and np.shape(x0) != np.shape(b):
+        x0 = None  # e.g. changed ensemble size
+    M = precond(A) if precond else None
+    info.iters = 0
+
+    def count(xk):
+        info.iters += 1
+
+    x, flag = method(A, b, x0=x0, M=M, maxiter=maxiter, callback=count, **{_RTOL: rtol})
+    if flag < 0 and fallback:
+        return fallback(A, b)
+    if flag:
+        # Don't fail silently
+        raise RuntimeError(f"{method.__name__} did not converge (info={flag}).")
+    return x
+
+
+@register("cg")
+def cg(A, b, x0=None, **kwargs):
+    """Conjugate gradients, with Jacobi preconditioning."""
+    return krylov(ssl.cg, A, b, x0, **kwargs)
+
+
+@register("minres")
+def minres(A, b, x0=None, **kwargs):
+    """MINRES, with Jacobi preconditioning."""
+    return krylov(ssl.minres, A, b, x0, **kwargs)
+
+
+@register("bicgstab")
+def bicgstab(A, b, x0=None, **kwargs):
+    """BiCGSTAB, with ILU preconditioning.
+
+    It often breaks down for strongly heterogeneous permeabilities
+    (even from a cold start), in which case `direct` is used instead.
+
+    Example:
+    >>> import simulator
+    >>> from tools import geostat
+    >>> model = simulator.ResSim(Nx=20, Ny=20, Lx=2, Ly=1)
+    >>> model.config_wells([[.5, .5, 1]], [[.1, .1, 1], [.9, .9, 1]])
+    >>> np.random.seed(1)
+    >>> x = geostat.gaussian_fields_fft(model.mesh(), r=0.8).reshape(model.shape)
+    >>> model.Gridded.K = np.stack([np.exp(5*x)]*2)  # as in MAIN
+    >>> P = model.pressure_step(np.zeros(model.M), model.Q)[0]
+    >>> model.solver = "bicgstab"
+    >>> np.allclose(model.pressure_step(np.zeros(model.M), model.Q)[0], P)
+    True
+    """
+    kwargs.setdefault("precond", ilu)
+    kwargs.setdefault("fallback", direct)
+    return krylov(ssl.bicgstab, A, b, x0, **kwargs)
+
+
+@register("amg")
+def cg_amg(A, b, x0=None, **kwargs):
+    """Conjugate gradients, with algebraic multigrid preconditioning."""
+    kwargs.setdefault("precond", amg)
+    return krylov(ssl.cg, A, b, x0, **kwargs)
+
+
+def get(solver):
+    """Look up `solver` in the registry, unless it's already a function."""
+    if callable(solver):
+        return solver
+    try:
+        return solvers[solver]
+    except KeyError:
+        raise KeyError(f"No such solver: {solver!r}. "
+                       f"Choose from {list(solvers)}.") from None
@@ -0,0 +1,146 @@
+"""Content-addressed caching (memoization), in memory and optionally on disk."""
+
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def fingerprint(*objs):
+    """Hash (hex string) of the *contents* of `objs`.
+
+    Supports arrays, scalars, strings, (nested) lists, tuples and dicts,
+    and objects (e.g. `ResSim`), whose public attributes are hashed.
+    Functions and classes are identified by their (qualified) name only.
+
+    Example:
+    >>> fingerprint(np.zeros(3), {"a": 1}) == fingerprint(np.zeros(3), {"a": 1})
+    True
+    >>> fingerprint(np.zeros(3)) == fingerprint(np.zeros(3, dtype=np.float32))
+    False
+    """
+    h = hashlib.sha1()
+
+    def feed(x):
+        if isinstance(x, np.ndarray):
+            h.update(f"array{x.dtype.str}{x.shape}".encode())
+            h.update(memoryview(np.ascontiguousarray(x)).cast("B"))
+        elif isinstance(x, dict):
+            h.update(f"dict{len(x)}".encode())
+            for k in sorted(x, key=repr):
+                feed(k)
+                feed(x[k])
+        elif isinstance(x, (list, tuple)):
+            h.update(f"{type(x).__name__}{len(x)}".encode())
+            for v in x:
+                feed(v)
+        elif callable(x) or not hasattr(x, "__dict__"):
+            name = getattr(x, "__qualname__", None)
+            h.update((f"{x.__module__}.{name}" if name else repr(x)).encode())
+        else:
+            h.update(type(x).__qualname__.encode())
+            feed({k: v for k, v in vars(x).items() if not k.startswith("_")})
+
+    for x in objs:
+        feed(x)
+    return h.hexdigest()
+
+
+def nbytes(x):
+    """Size (bytes) of the arrays in `x`, including (nested) lists, tuples and dicts.
+
+    >>> nbytes((np.zeros(3), [np.zeros((2, 2), np.float32)], "other"))
+    40
+    """
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        return sum(nbytes(v) for v in x)
+    return 0
+
+
+class LRUCache:
+    """Dict-like cache that evicts the least-recently used items beyond `maxsize`.
+
+    Also evicts beyond `maxbytes` (if given), the total size of the arrays (see
+    `nbytes`) of the items.
+
+    If a `directory` is given, the items are also stored there (pickled),
+    so that they persist (e.g. between sessions), and are not limited by `maxsize`.
+    It is created when first written to, so it may also be set after creation.
+    Keys must be strings, e.g. from `fingerprint`.
+
+    Example:
+    >>> cache = LRUCache(maxsize=2)
+    >>> for key in "abc":
+    ...     cache[key] = key.upper()
+    >>> list(cache.items), cache.get("a")
+    (['b', 'c'], None)
+    """
+
+    def __init__(self, maxsize=1000, directory=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self.items = OrderedDict()
+        self.sizes = {}
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def __getitem__(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        if self.directory and os.path.exists(self.path(key)):
+            with open(self.path(key), "rb") as F:
+                value = pickle.load(F)
+            self._store(key, value)
+            return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._store(key, value)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write atomically (in case of concurrent readers)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as F:
+                pickle.dump(value, F, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+
+    def _store(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        self.sizes[key] = nbytes(value)
+        while self.items and (len(self.items) > self.maxsize or
+                              self.maxbytes is not None and
+                              self.nbytes > self.maxbytes):
+            key, _ = self.items.popitem(last=False)
+            del self.sizes[key]
+
+    @property
+    def nbytes(self):
+        """Total size of the arrays of the items (in memory)."""
+        return sum(self.sizes.values())
+
+    def __contains__(self, key):
+        if key in self.items:
+            return True
+        return bool(self.directory) and os.path.exists(self.path(key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        """Clear the memory (but not the `directory`)."""
+        self.items.clear()
+        self.sizes.clear()
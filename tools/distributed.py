@@ -0,0 +1,216 @@
+"""Distributed (multi-node) ensemble map, using a job queue served over TCP.
+
+The `Coordinator` serves a queue of member tasks, and a queue of results
+(using `multiprocessing.managers`). Workers, on this or other machines,
+connect to it, pull tasks, and push back the results (as they finish).
+Start a worker with
+
+    python -m tools.distributed HOST:PORT AUTHKEY
+
+from the root of the repository (so that the same code can be imported),
+where `AUTHKEY` (hex) is that of the coordinator; see `Coordinator.command`.
+"""
+
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.managers import BaseManager
+
+from tqdm.auto import tqdm as progbar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Coordinator:
+    """Serves the members of ensemble forecasts to (local and/or remote) workers.
+
+    Has the same interface as `parallel.Pool`. The function `fun` (typically
+    a closure including the model template) is sent to each worker only once
+    (pickled with `dill`), while the tasks consist of the member inputs
+    and `kwargs`.
+
+    - `address`: (host, port) to serve on. Use `("", port)` to accept remote workers.
+    - `host`: that of `address` as reached by the (remote) workers; see `command`.
+      If None: that of `address`, or (if serving on all interfaces) `socket.getfqdn()`.
+    - `num_workers`: number of workers to start on this machine.
+      If None: one per CPU. If 0: rely entirely on remote workers.
+    - `authkey`: bytes. If None: random.
+    - `timeout`: seconds to wait for (any) result before re-queuing the unfinished
+      members (in case their worker died). If none arrives within another
+      `timeout`, these are returned as `TimeoutError` (instances). If None: no limit.
+
+    Example:
+    >>> import numpy as np
+    >>> def fun(member, c=0):
+    ...     x, y = member
+    ...     return x @ y + c
+    >>> with Coordinator(fun, num_workers=2) as pool:
+    ...     pool.map(np.eye(3), np.ones((3, 3)), c=1, pbar=False)
+    [2.0, 2.0, 2.0]
+    """
+
+    def __init__(self, fun, address=("localhost", 0), num_workers=None, authkey=None,
+                 host=None, timeout=None):
+        import dill  # installed with `multiprocess`
+
+        self.authkey = authkey or os.urandom(16)
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.job = 0
+        self.timeout = timeout
+        fun = dill.dumps(fun, recurse=True)
+
+        # Serve (in a thread of this process)
+        class Manager(BaseManager):
+            pass
+        Manager.register("tasks", callable=lambda: self.tasks)
+        Manager.register("results", callable=lambda: self.results)
+        Manager.register("fun", callable=lambda: fun)
+        self.server = Manager(tuple(address), self.authkey).get_server()
+        self.server.stop_event = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+        bound, port = self.server.address
+        everywhere = bound in ["", "0.0.0.0"]
+        self.address = (host or (socket.getfqdn() if everywhere else bound), port)
+
+        # Start local workers
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        local = ("localhost", port) if everywhere else None
+        self.workers = [subprocess.Popen(self.command(local).split(), cwd=ROOT)
+                        for _ in range(num_workers)]
+
+    def _serve(self):
+        """Like `server.serve_forever`, but stoppable, and without its `sys.exit`."""
+        server = self.server
+        while not server.stop_event.is_set():
+            try:
+                conn = server.listener.accept()
+            except Exception:
+                continue  # e.g. failed authentication, or closed
+            handler = threading.Thread(target=server.handle_request, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def command(self, address=None):
+        """Shell command to start a worker (also on another machine).
+
+        It connects to `address`, by default `self.address`.
+        """
+        host, port = address or self.address
+        key = self.authkey.hex()
+        return f"{sys.executable} -m tools.distributed {host}:{port} {key}"
+
+    def imap(self, *args, **kwargs):
+        """Yield `(i, fun(member_i, **kwargs))` as the members finish (in any order)."""
+        self.job += 1
+        pending = {}
+        for i, member in enumerate(zip(*args)):
+            pending[i] = (self.job, i, member, kwargs)
+            self.tasks.put(pending[i])
+        requeued = False
+        try:
+            while pending:
+                try:
+                    job, i, ok, result = self.results.get(timeout=self.timeout)
+                except queue.Empty:
+                    if requeued:
+                        for i in list(pending):
+                            del pending[i]
+                            yield i, TimeoutError(f"No result for member {i}.")
+                        break
+                    # Their worker may have died, so give them to another
+                    self._withdraw()
+                    for task in pending.values():
+                        self.tasks.put(task)
+                    requeued = True
+                    continue
+                if job != self.job or i not in pending:
+                    continue  # from an aborted job, or a duplicate (re-queued)
+                if not ok:
+                    raise RuntimeError(f"Member {i} failed (on worker):\n{result}")
+                del pending[i]
+                yield i, result
+        finally:
+            self._withdraw()  # in case of abort
+
+    def _withdraw(self):
+        """Withdraw the tasks that are not yet started."""
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+
+    def map(self, *args, desc="", pbar=True, **kwargs):  # noqa
+        """Compute `[fun(member, **kwargs) for member in zip(*args)]`, in parallel."""
+        N = len(args[0])
+        results = self.imap(*args, **kwargs)
+        if pbar:
+            results = progbar(results, desc, N)
+        output = [None]*N
+        for i, result in results:
+            output[i] = result
+        return output
+
+    def close(self, timeout=10):
+        """Stop the workers. Local ones still busy after `timeout` (seconds) are killed.
+
+        E.g. those stuck on members that timed out (see `timeout`).
+        """
+        for _ in self.workers:
+            self.tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for w in self.workers:
+            try:
+                w.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                w.kill()
+                w.wait()
+        # Remote workers exit once they lose the connection.
+        self.server.stop_event.set()
+        self.server.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def worker(address, authkey):
+    """Pull tasks from the coordinator at `address`, until told (or forced) to stop."""
+    import dill
+
+    class Manager(BaseManager):
+        pass
+    for name in ["tasks", "results", "fun"]:
+        Manager.register(name)
+    manager = Manager(tuple(address), authkey)
+    manager.connect()
+    tasks, results = manager.tasks(), manager.results()
+    fun = dill.loads(manager.fun()._getvalue())
+
+    while True:
+        try:
+            task = tasks.get()
+        except (EOFError, OSError):
+            break  # coordinator gone
+        if task is None:
+            break
+        job, i, member, kwargs = task
+        try:
+            output = (job, i, True, fun(member, **kwargs))
+        except Exception:
+            output = (job, i, False, traceback.format_exc())
+        results.put(output)
+
+
+if __name__ == "__main__":
+    host, port = sys.argv[1].rsplit(":", 1)
+    worker((host, int(port)), bytes.fromhex(sys.argv[2]))
@@ -1,11 +1,23 @@
 """Generate initial reservoir realisations with geostatistical methods."""
 
+import warnings
+
 import numpy as np
+import scipy.fft as sfft
 import scipy.linalg as sla
+import scipy.sparse.linalg as ssl
 from matplotlib import pyplot as plt
 from mpl_tools.place import freshfig
 from numpy.random import randn
 
+from tools import cache
+
+# Cache of the covariance factors (see `cov_factor`), e.g. of the prior,
+# which is sampled repeatedly (truth, ensemble, ...). To persist them on disk
+# (i.e. between sessions), set `geostat.factors.directory` (a path).
+# The memory is bounded (the dense factors of a 64x64 mesh take 134 MB each).
+factors = cache.LRUCache(maxsize=8, maxbytes=2**28)
+
 
 def variogram_gauss(xx, r, n=0, a=1/3):
     """Compute the Gaussian variogram for the 1D points xx.
@@ -52,17 +64,222 @@ def dist_euclid(X):
     return np.sqrt(d2)
 
 
-def gaussian_fields(pts, N=1, r=0.2):
+def cov_factor(pts, r=0.2, rank=None, **kwargs):
+    """Get `C12` such that `C12 @ C12.T` is the covariance of `gaussian_fields`.
+
+    The covariance is `1 - variogram_gauss` (with `r` and `kwargs`) between `pts`.
+    If `rank` is None, `C12` is its (symmetric) square root. Otherwise, it is truncated
+    to the `rank` leading eigenvectors (scaled by the square root of the eigenvalues),
+    of shape `(M, rank)`, so that sampling costs O(M rank) rather than O(M^2).
+
+    The factors are cached (in `factors`), keyed on the contents of the arguments,
+    so that only the first call (for a given mesh, range, ...) is costly.
+    Being shared, they are read-only (copy them to modify).
+
+    Example:
+    >>> pts = np.meshgrid(np.linspace(0, 1, 5), np.linspace(0, 1, 4), indexing="ij")
+    >>> C12 = cov_factor(pts, 0.5, rank=6)
+    >>> C12.shape, cov_factor(pts, 0.5, rank=6) is C12, C12.flags.writeable
+    ((20, 6), True, False)
+    """
+    key = cache.fingerprint("cov_factor", pts, r, rank, kwargs)
+    C12 = factors.get(key)
+    if C12 is None:
+        Cov = 1 - variogram_gauss(dist_euclid(vectorize(*pts)), r, **kwargs)
+        if rank is None:
+            C12 = sla.sqrtm(Cov).real
+        else:
+            M = len(Cov)
+            eigvals, U = sla.eigh(Cov, subset_by_index=[M - rank, M - 1])
+            C12 = U[:, ::-1] * np.sqrt(np.maximum(eigvals[::-1], 0))
+        factors[key] = C12
+    C12.flags.writeable = False  # also if loaded from disk
+    return C12
+
+
+def gaussian_fields(pts, N=1, r=0.2, rank=None):
     """Random field generation.
 
     Uses:
     - Gaussian variogram.
     - Gaussian distributions.
+
+    The factorisation of the covariance is cached, and may be truncated (see
+    `cov_factor`). Repeated sampling (for the same `pts` and `r`) is therefore
+    just a matrix multiplication.
+    """
+    C12    = cov_factor(pts, r, rank)
+    fields = randn(N, C12.shape[1]) @ C12.T
+    return fields
+
+
+def mesh_spacing(pts):
+    """Get the shape and (uniform) spacings of the regular mesh `pts`.
+
+    Example:
+    >>> mesh_spacing(np.meshgrid([0, 2, 4], [0, .5], indexing="ij"))
+    ((3, 2), [2.0, 0.5])
+    """
+    shape = np.shape(pts[0])
+    if len(pts) != len(shape):
+        raise ValueError("The mesh must be as from `np.meshgrid(..., indexing='ij')`.")
+    hh = []
+    for i, X in enumerate(pts):
+        h = np.diff(X, axis=i)
+        others = [np.diff(X, axis=j) for j in range(len(shape)) if j != i]
+        if not np.allclose(h, h.flat[0] if h.size else 0) or np.any(others):
+            raise ValueError("The mesh must be regular (e.g. from `Grid2D.mesh`).")
+        hh.append(float(h.flat[0]) if h.size else 1.0)
+    return shape, hh
+
+
+def circulant_embedding(shape, hh, r, tol=1e-8, **kwargs):
+    """Eigenvalues of the periodic (circulant) embedding of the Gaussian covariance.
+
+    The periodic domain is padded until the covariance (`1 - variogram_gauss`, with
+    `kwargs`) is below `tol` at half its length, so that the embedding is
+    (practically) non-negative definite. Negative eigenvalues are clipped to 0.
+    """
+    a = kwargs.get("a", 1/3)
+    cutoff = r*np.sqrt(-a*np.log(tol))
+    mm = [sfft.next_fast_len(max(2*(n-1), 2*int(np.ceil(cutoff/h)), 1))
+          for n, h in zip(shape, hh)]
+    lags = [h*np.minimum(np.arange(m), m - np.arange(m)) for m, h in zip(mm, hh)]
+    dists = np.sqrt(sum(L**2 for L in np.meshgrid(*lags, indexing="ij")))
+    eigvals = sfft.fftn(1 - variogram_gauss(dists, r, **kwargs)).real
+    if eigvals.min() < -1e-6*eigvals.max():
+        warnings.warn("Circulant embedding not non-negative definite"
+                      f" (min. eigenvalue: {eigvals.min():.2g}). Clipping.",
+                      stacklevel=2)
+    return np.maximum(eigvals, 0)
+
+
+def gaussian_fields_fft(pts, N=1, r=0.2, batch=2**22):
+    """Like `gaussian_fields`, but using FFT (circulant embedding).
+
+    The fields have the same (stationary) distribution, but cost O(N M log M),
+    rather than O(M^3), and require O(M) memory, rather than O(M^2),
+    where `M` is the number of points. However, the mesh must be regular,
+    e.g. from `Grid2D.mesh`. The fields are generated `batch/M` at a time
+    (less if the embedding needs much padding), to limit memory use.
+
+    Example:
+    >>> grid = np.meshgrid(np.linspace(0, 1, 5), np.linspace(0, 1, 4), indexing="ij")
+    >>> fields = gaussian_fields_fft(grid, 10**4, r=0.5)
+    >>> fields.shape
+    (10000, 20)
+    >>> Cov = 1 - variogram_gauss(dist_euclid(vectorize(*grid)), 0.5)
+    >>> np.abs(np.cov(fields.T) - Cov).max() < 0.1
+    True
+    """
+    shape, hh = mesh_spacing(pts)
+    eigvals = circulant_embedding(shape, hh, r)
+    scale = np.sqrt(eigvals/eigvals.size)
+    inside = tuple(slice(n) for n in shape)
+    axes = tuple(range(1, 1+len(shape)))
+
+    fields = np.empty((N, np.prod(shape)))
+    # NB: the real and imaginary parts yield two (independent) fields.
+    step = 2*max(1, batch//eigvals.size)
+    for i0 in range(0, N, step):
+        n = min(step, N - i0)
+        Z = randn(2, (n+1)//2, *eigvals.shape)
+        F = sfft.fftn((Z[0] + 1j*Z[1]) * scale, axes=axes)
+        F = np.concatenate([F.real, F.imag])[:n]
+        fields[i0:i0+n] = F[(slice(None),) + inside].reshape(n, -1)
+    return fields
+
+
+def cov_operator(pts, r=0.2, **kwargs):
+    """The covariance of `gaussian_fields`, as a `LinearOperator`.
+
+    For regular meshes, its products are computed by FFT (see `circulant_embedding`),
+    costing O(M log M), rather than O(M^2), and without storing the (M x M) matrix.
+    """
+    try:
+        shape, hh = mesh_spacing(pts)
+    except ValueError:
+        return ssl.aslinearoperator(
+            1 - variogram_gauss(dist_euclid(vectorize(*pts)), r, **kwargs))
+    eigvals = circulant_embedding(shape, hh, r, **kwargs)
+    inside = tuple(slice(n) for n in shape)
+
+    def matvec(x):
+        X = np.zeros(eigvals.shape)
+        X[inside] = x.reshape(shape)
+        return sfft.ifftn(eigvals * sfft.fftn(X)).real[inside].ravel()
+
+    M = np.prod(shape)
+    return ssl.LinearOperator((M, M), matvec, rmatvec=matvec, dtype=float)
+
+
+def kl_factor(pts, r=0.2, energy=0.99, max_rank=None, k0=32, **kwargs):
+    """Truncated Karhunen-Loeve (eigen) factor, `U * sqrt(eigvals)`, of `cov_operator`.
+
+    The rank is the smallest that retains the fraction `energy` of the total variance
+    (i.e. the trace, `M`), but at most `max_rank`. The leading eigenpairs are computed
+    by Lanczos (`eigsh`), starting with `k0` of them, and doubling until enough
+    (or until it's cheaper to compute them all, with `eigh`).
+
+    The factors are cached (in `factors`), and read-only, like those of `cov_factor`.
+
+    Example:
+    >>> pts = np.meshgrid(np.linspace(0, 2, 20), np.linspace(0, 1, 20), indexing="ij")
+    >>> kl_factor(pts, r=0.8, energy=0.99).shape
+    (400, 24)
+    """
+    key = cache.fingerprint("kl_factor", pts, r, energy, max_rank, kwargs)
+    C12 = factors.get(key)
+    if C12 is not None:
+        C12.flags.writeable = False  # if loaded from disk
+        return C12
+
+    Cov = cov_operator(pts, r, **kwargs)
+    M = Cov.shape[0]
+    trace = M  # since the variogram has sill 1
+    max_rank = min(max_rank or M, M)
+    k = min(k0, max_rank)
+    v0 = np.random.RandomState(0).randn(M)  # fixed (for reproducibility)
+    while True:
+        if 2*k >= M:
+            eigvals, U = sla.eigh(Cov @ np.eye(M))
+        else:
+            eigvals, U = ssl.eigsh(Cov, k, which="LA", v0=v0)
+        eigvals, U = eigvals[::-1], U[:, ::-1]
+        if eigvals.sum() >= energy*trace or k >= max_rank or 2*k >= M:
+            break
+        k = min(2*k, max_rank)
+
+    rank = np.searchsorted(np.cumsum(eigvals), energy*trace) + 1
+    rank = min(rank, max_rank, len(eigvals))
+    if np.sum(eigvals[:rank]) < energy*trace:
+        warnings.warn(f"Retaining only {np.sum(eigvals[:rank])/trace:.3g} of the"
+                      f" variance with max_rank={max_rank}.", stacklevel=2)
+    U = U[:, :rank] * np.sign(U[np.argmax(abs(U[:, :rank]), 0), range(rank)])
+    C12 = U * np.sqrt(np.maximum(eigvals[:rank], 0))
+    C12.flags.writeable = False
+    factors[key] = C12
+    return C12
+
+
+def kl_fields(pts, N=1, r=0.2, energy=0.99, **kwargs):
+    """Like `gaussian_fields`, but using the truncated Karhunen-Loeve expansion.
+
+    I.e. `randn(N, rank) @ C12.T`, with `C12 = kl_factor(pts, r, energy, **kwargs)`.
+    Thus, sampling costs O(M rank) rather than O(M^2), and so does storing `C12`.
+    The fields only retain the `energy` fraction of the variance, but the discarded
+    part is that of the smallest scales, which is small for a smooth covariance
+    (large `r`), as can be seen from its spectrum.
+
+    Example:
+    >>> pts = np.meshgrid(np.linspace(0, 2, 20), np.linspace(0, 1, 20), indexing="ij")
+    >>> fields = kl_fields(pts, 10**4, r=0.8)
+    >>> Cov = 1 - variogram_gauss(dist_euclid(vectorize(*pts)), 0.8)
+    >>> np.abs(np.cov(fields.T) - Cov).max() < 0.1
+    True
     """
-    dists  = dist_euclid(vectorize(*pts))
-    Cov    = 1 - variogram_gauss(dists, r)
-    C12    = sla.sqrtm(Cov).real
-    fields = randn(N, len(dists)) @ C12.T
+    C12    = kl_factor(pts, r, energy, **kwargs)
+    fields = randn(N, C12.shape[1]) @ C12.T
     return fields
 
 
@@ -5,36 +5,77 @@ import scipy.linalg as sla
 from tqdm.auto import tqdm as progbar
 
 
-def repeat(model_step, nSteps, x0, dt, obs_model=None, pbar=True, **kwargs):
+def stream(model_step, nSteps, x0, dt, pbar=False, **kwargs):
+    """Like `repeat`, but yield (rather than store) the states, one at a time.
+
+    Yields `(iT, x)`, where `x` is the state at time index `iT = 1, ..., nSteps`.
+    Thus, memory usage does not grow with `nSteps`.
+
+    Example:
+    >>> for iT, x in stream(lambda x, dt: x + dt, 3, np.zeros(2), 0.5):
+    ...     print(iT, x)
+    1 [0.5 0.5]
+    2 [1. 1.]
+    3 [1.5 1.5]
+    """
+    # Range with or w/o progbar
+    rge = range(1, nSteps+1)
+    if pbar:
+        rge = progbar(rge, "Simulation")
+
+    x = x0
+    for iT in rge:
+        x = model_step(x, dt, **kwargs)
+        yield iT, x
+
+
+def repeat(model_step, nSteps, x0, dt, obs_model=None, pbar=True, dtype=float,
+           snapshots=None, **kwargs):
     """Recursively apply `model_step` `nSteps` times. Also apply `obs_model`.
 
     Note that the output time series of states includes the initial conditions
     `x0`, while the observation model is not applied at time 0, so that
     `len(xx) = len(yy) + 1`.
-    """
-    # Range with or w/o progbar
-    rge = np.arange(nSteps)
-    if pbar:
-        rge = progbar(rge, "Simulation")
 
-    # Init
-    xx = np.zeros((nSteps+1,)+x0.shape)
-    xx[0] = x0
+    NB: `dt` is the output (report) interval. The model may well use
+    (adaptive) internal time steps, as with `ResSim.dS_tol`.
 
-    # Step
-    for iT in rge:
-        xx[iT+1] = model_step(xx[iT], dt, **kwargs)
+    The outputs are stored with the given `dtype`. Using `np.float32` halves
+    their memory, but does not affect the precision of the recursion itself.
 
-    # Observe
-    if obs_model:
-        for iT in rge:
-            y = obs_model(xx[iT+1])
-            if iT == 0:
-                yy = np.zeros((nSteps,)+(len(y),))
-            yy[iT] = y
+    To save memory, use `snapshots` to select the (time indices of) the states
+    to keep, e.g. `snapshots=[-1]` to only keep the final state.
+    The observations are always kept (and computed on the fly).
 
-        return xx, yy
+    Example:
+    >>> xx, yy = repeat(lambda x, dt: x + dt, 4, np.zeros(2), 1, sum, pbar=False,
+    ...                 snapshots=[0, -1])
+    >>> xx
+    array([[0., 0.],
+           [4., 4.]])
+    >>> yy
+    array([2., 4., 6., 8.])
+    """
+    # Init
+    kept = np.arange(nSteps+1)
+    if snapshots is not None:
+        kept = np.atleast_1d(kept[snapshots])
+    xx = np.zeros((len(kept),)+x0.shape, dtype)
+    xx[kept == 0] = x0
+    yy = None
+
+    # Step (and observe)
+    # NB: recurses on `x` rather than `xx[iT]` (which may have lower precision)
+    for iT, x in stream(model_step, nSteps, x0, dt, pbar, **kwargs):
+        xx[kept == iT] = x
+        if obs_model:
+            y = obs_model(x)
+            if yy is None:
+                yy = np.zeros((nSteps,)+np.shape(y), dtype)
+            yy[iT-1] = y
 
+    if obs_model:
+        return xx, yy
     else:
         return xx
 
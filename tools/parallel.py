@@ -0,0 +1,172 @@
+"""Parallel (ensemble) map, with a persistent pool of worker processes (or threads)."""
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from tqdm.auto import tqdm as progbar
+
+# State of each worker process
+_worker = {}
+
+
+def _init(fun):
+    _worker["fun"] = fun
+    _worker["arrays"] = {}
+
+
+def _run(task):
+    """Run member `i`, reading its inputs from the (memory-mapped) ensemble arrays."""
+    i, paths, kwargs = task
+    arrays = _worker["arrays"]
+    if list(arrays) != paths:
+        # New ensemble => release previous, attach new.
+        arrays.clear()
+        arrays.update({p: np.load(p, mmap_mode="r") for p in paths})
+    member = tuple(np.array(arrays[p][i]) for p in paths)
+    return i, _worker["fun"](member, **kwargs)
+
+
+def shm_dir():
+    """Dir. for sharing arrays. Uses RAM (`/dev/shm`) if available."""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class Pool:
+    """Persistent pool of processes for mapping `fun` over ensemble members.
+
+    Starting processes, and sending them `fun` (a closure, typically including
+    the model template), is only done once, at creation, and the pool can then
+    be re-used for every ensemble forecast (IES iterations, EnOpt steps, ...).
+
+    The ensemble inputs are shared via memory-mapped (`/dev/shm`) files,
+    so that only the member indices (and any `kwargs`) are sent to the workers.
+
+    Uses `multiprocess` (installed with `p_tqdm`) which, using `dill`,
+    can also pickle closures (needed unless the start method is "fork").
+
+    If no result arrives within `timeout` seconds (e.g. a member is stuck,
+    or its worker died), the unfinished members are returned as `TimeoutError`
+    (instances), and the workers are replaced. If None: no limit.
+
+    Example:
+    >>> def fun(member, c=0):
+    ...     x, y = member
+    ...     return x @ y + c
+    >>> with Pool(fun, 2) as pool:
+    ...     pool.map(np.eye(3), np.ones((3, 3)), c=1, pbar=False)
+    [2.0, 2.0, 2.0]
+    """
+
+    def __init__(self, fun, num_cpus=None, timeout=None):
+        import multiprocess as mp
+        self.fun = fun
+        self.num_cpus = num_cpus or mp.cpu_count()
+        self.timeout = timeout
+        self.start()
+
+    def start(self):
+        import multiprocess as mp
+        self.pool = mp.Pool(self.num_cpus, initializer=_init, initargs=(self.fun,))
+
+    def imap(self, *args, **kwargs):
+        """Yield `(i, fun(member_i, **kwargs))` as the members finish (in any order)."""
+        import multiprocess as mp
+        N = len(args[0])
+        tmpdir = tempfile.mkdtemp(prefix="ens_", dir=shm_dir())
+        try:
+            paths = []
+            for j, arr in enumerate(args):
+                paths.append(os.path.join(tmpdir, f"arg{j}.npy"))
+                np.save(paths[-1], np.asarray(arr))
+            tasks = [(i, paths, kwargs) for i in range(N)]
+            results = self.pool.imap_unordered(_run, tasks)
+            pending = set(range(N))
+            while pending:
+                try:
+                    i, result = results.next(self.timeout)
+                except mp.TimeoutError:
+                    break
+                pending.remove(i)
+                yield i, result
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        if pending:
+            # Replace the stuck (or dead) workers
+            self.pool.terminate()
+            self.start()
+            for i in sorted(pending):
+                yield i, TimeoutError(f"No result for member {i}.")
+
+    def map(self, *args, desc="", pbar=True, **kwargs):  # noqa
+        """Compute `[fun(member, **kwargs) for member in zip(*args)]`, in parallel."""
+        N = len(args[0])
+        results = self.imap(*args, **kwargs)
+        if pbar:
+            results = progbar(results, desc, N)
+        output = [None]*N
+        for i, result in results:
+            output[i] = result
+        return output
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ThreadPool(Pool):
+    """Like `Pool`, but using threads (of this process).
+
+    There are no start-up or pickling costs, nor any need for `fork`
+    (problematic in some notebook environments, see `requirements.txt`).
+    But only the parts of `fun` that release the GIL (e.g. `spsolve`
+    and large numpy operations) run concurrently.
+
+    NB: `fun` must be thread-safe, e.g. derive the model of each member
+    using `ResSim.with_params` (rather than modifying a shared one).
+    Threads cannot be killed, so those of timed out members are abandoned
+    (and keep running until done).
+
+    Example:
+    >>> with ThreadPool(lambda member, c=0: sum(member) + c, 2) as pool:
+    ...     pool.map([1, 2], [10, 20], c=100, pbar=False)
+    [111, 122]
+    """
+
+    def __init__(self, fun, num_cpus=None, timeout=None):
+        self.fun = fun
+        self.num_cpus = num_cpus or os.cpu_count()
+        self.timeout = timeout
+        self.start()
+
+    def start(self):
+        self.pool = ThreadPoolExecutor(self.num_cpus)
+
+    def imap(self, *args, **kwargs):
+        futures = {self.pool.submit(self.fun, member, **kwargs): i
+                   for i, member in enumerate(zip(*args))}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, self.timeout, FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                yield futures[future], future.result()
+        if pending:
+            for future in pending:
+                future.cancel()
+            self.pool.shutdown(wait=False)
+            self.start()
+            for i in sorted(futures[future] for future in pending):
+                yield i, TimeoutError(f"No result for member {i}.")
+
+    def close(self):
+        self.pool.shutdown()